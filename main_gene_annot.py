@@ -24,7 +24,13 @@ from utils import save_args_log, enumerate_snippets
 from utils import select_genes
 from utils import pull_genes_for_uniprot
 
-from utils_gpt import get_gpt_genes_response, get_gpt_family_response, verbose_gpu_usage
+from utils_cache import DiskCache
+from utils_snippet_store import init_sqlite_store
+from utils_dedup import find_duplicate_snippets
+from utils_batch import add_genes_to_batch, get_gene_summaries_path
+from utils_famfilter import init_spec_index
+
+from utils_gpt import get_gpt_genes_response, get_gpt_family_response, verbose_gpu_usage, save_gpu_usage, init_response_cache, load_model_prices, init_pmid_cache
 from utils_gpt import factcheck_summary, factcheck_gene_summary
 
 
@@ -46,11 +52,37 @@ def main():
     parser.add_argument("-max2", "--max-pages-per-gene", type=int, default=1, help='maximum number of pages per gene to parse, default=1')
     parser.add_argument("-max3", "--max-genes-each-type", type=int, default=1000, help='maximum number of genes')
     parser.add_argument('-s', '--snippet-window-size', type=int, default=300, help='snippet window size in characters, snippet will be 2 times longer')
+    parser.add_argument('-workers', '--workers', type=int, default=1, help='number of genes searched for snippets in parallel, default=1')
+    parser.add_argument('-fam-extract', '--family-extract', type=int, default=0, help='parse every paper once and find all genes of the family in it, default=0 (per-gene search)')
+    parser.add_argument('-xw', '--xml-workers', type=int, default=1, help='number of concurrent full-text XML downloads per gene, default=1 (sequential)')
+    
+    parser.add_argument('-store', '--snippet-store', type=str, choices=["csv", "sqlite"], default="csv", help='how snippets are stored: one CSV file per gene or one SQLite file per family, default=csv')
+    parser.add_argument('-xml-cache', '--xml-cache', type=str, default=None, help='directory of the full-text XML cache, can be shared between runs. Not used by default')
+    parser.add_argument('-xml-cache-size', '--xml-cache-size', type=int, default=2048, help='size cap of the full-text XML cache in MB, default=2048')
+    
+    parser.add_argument('-renum', '--renumber-snippets', type=int, default=0, help='assign snippet IDs to all genes again, default=0 (only to genes added since last run)')
     
     parser.add_argument('-N1', '--num-snippets-in-prompt', type=int, default=100)
+    parser.add_argument('-T', '--prompt-token-budget', type=int, default=0, help='pack snippets into gene prompts of up to this number of tokens instead of N1 snippets per prompt, default=0 (off)')
+    parser.add_argument('-pack', '--packing', type=str, choices=["greedy", "first-fit"], default="greedy", help='how snippets are packed into prompts with token budget, default=greedy')
+    parser.add_argument('-dedup', '--dedup-threshold', type=float, default=0, help='similarity threshold for removing near-duplicate snippets from prompts, e.g. 0.8, default=0 (off)')
+    parser.add_argument('-rank', '--rank-snippets', type=int, default=0, help='sort snippets of a gene by relevance (BM25) before joining them into prompts, default=0')
     parser.add_argument('-N', '--gpt4-n', type=int, default=10)
     parser.add_argument('-run-gpt', '--run-gpt', type=int, default=0)
+    parser.add_argument('-mr', '--map-reduce-chunks', type=int, default=1, help='summarize up to this number of prompts of each gene in parallel and merge the summaries, default=1 (only the first prompt)')
+    parser.add_argument('-llm-cache', '--llm-cache', type=str, default=None, help='directory of the LLM response cache, can be shared between runs. Not used by default')
+    parser.add_argument('-llm-cache-size', '--llm-cache-size', type=int, default=512, help='size cap of the LLM response cache in MB, default=512')
+    parser.add_argument('-llm-cache-bypass', '--llm-cache-bypass', type=int, default=0, help='request all responses again (they are still saved to the cache), default=0')
+    parser.add_argument('-prices', '--prices', type=str, default=None, help='JSON file with model prices in USD per 1M tokens, added to the built-in price table: {"model": {"input": ..., "cached_input": ..., "output": ...}}')
+    parser.add_argument('-pmid-cache', '--pmid-cache', type=str, default=None, help='JSONL file with PMCID -> PMID conversions, shared between runs and families, default={dir_name}/pmcid_to_pmid.jsonl')
+    parser.add_argument('-batch-dir', '--batch-dir', type=str, default=None, help='add gene summarization requests to this batch directory instead of calling the API, see utils_batch.py. Not used by default')
+    parser.add_argument('-run-name', '--run-name', type=str, default=None, help='continue an existing run (name of the run directory) instead of starting a new one')
+    parser.add_argument('-gpt-workers', '--gpt-workers', type=int, default=1, help='number of genes summarized in parallel (and of API calls in flight), default=1')
     parser.add_argument('-sf', '--do-spec-filter', type=int, default=1)
+    parser.add_argument('-spec-workers', '--spec-workers', type=int, default=4, help='number of genes checked for specificity in UniProt in parallel (ahead of the current gene), default=4')
+    parser.add_argument('-spec-batch', '--spec-batch', type=int, default=1, help='number of genes checked for specificity with one UniProt query, default=1')
+    parser.add_argument('-spec-index', '--spec-index', type=str, default=None, help='directory of the offline specificity index (see utils_specindex.py), UniProt is not queried if set')
+    parser.add_argument('-spec-ttl', '--spec-ttl', type=float, default=30, help='gene specificity statistics older than this number of days are queried in UniProt again, default=30')
     
     parser.add_argument('-v', '--verbose', type=int, default=0)
 
@@ -72,35 +104,59 @@ def main():
     mkdirsafe(f'{args.dir_name}/{args.query}/tmp')
     now = datetime.now()
     run_name = now.strftime(f"run_results_{config['model']}_%Y-%m-%d %H:%M:%S")
+    if args.run_name is not None:
+        run_name = args.run_name
     mkdirsafe(f'{args.dir_name}/{args.query}/{run_name}')
     save_args_log(args, config, run_name)
     print(f'LOG: run_name {run_name}. Arguments logged in run_args.log')
 
     ''' Getting and saving snippets; Joining snippets into prompts '''
+    if args.snippet_store == "sqlite":
+        init_sqlite_store(args.query, args.dir_name)
+    xml_cache = None
+    if args.xml_cache is not None:
+        xml_cache = DiskCache(args.xml_cache, max_size_mb=args.xml_cache_size)
 
     if args.mode == "from-fam-acc":
         pull_genes(family=args.query, dir=args.dir_name, max_pages=args.max_pages_per_family, force_flag=args.FORCE)
-        num_genes_with_snippets = get_save_gene_snippets(args.query, args.dir_name, args.max_pages_per_gene, args.snippet_window_size, force_flag=args.FORCE, from_gene_list=False, max_genes_each_type=args.max_genes_each_type, gene_list_filename=args.gene_list)
+        num_genes_with_snippets = get_save_gene_snippets(args.query, args.dir_name, args.max_pages_per_gene, args.snippet_window_size, force_flag=args.FORCE, from_gene_list=False, max_genes_each_type=args.max_genes_each_type, gene_list_filename=args.gene_list, xml_workers=args.xml_workers, gene_workers=args.workers, xml_cache=xml_cache, family_extract=args.family_extract)
 
     if args.mode == "from-gene-list":
-        num_genes_with_snippets = get_save_gene_snippets(args.query, args.dir_name, args.max_pages_per_gene, args.snippet_window_size, force_flag=args.FORCE, from_gene_list=True, max_genes_each_type=args.max_genes_each_type, gene_list_filename=args.gene_list)
+        num_genes_with_snippets = get_save_gene_snippets(args.query, args.dir_name, args.max_pages_per_gene, args.snippet_window_size, force_flag=args.FORCE, from_gene_list=True, max_genes_each_type=args.max_genes_each_type, gene_list_filename=args.gene_list, xml_workers=args.xml_workers, gene_workers=args.workers, xml_cache=xml_cache, family_extract=args.family_extract)
     
     if args.mode == "from-uniprot-list":
         gene_list_filename = pull_genes_for_uniprot(family=args.query, dir_name=args.dir_name, uniprot_accs_path=args.uniprot_list, max_pages=args.max_pages_per_family, force_flag=args.FORCE)
-        num_genes_with_snippets = get_save_gene_snippets(args.query, args.dir_name, args.max_pages_per_gene, args.snippet_window_size, force_flag=args.FORCE, from_gene_list=True, max_genes_each_type=args.max_genes_each_type, gene_list_filename=gene_list_filename)
+        num_genes_with_snippets = get_save_gene_snippets(args.query, args.dir_name, args.max_pages_per_gene, args.snippet_window_size, force_flag=args.FORCE, from_gene_list=True, max_genes_each_type=args.max_genes_each_type, gene_list_filename=gene_list_filename, xml_workers=args.xml_workers, gene_workers=args.workers, xml_cache=xml_cache, family_extract=args.family_extract)
 
-    enumerate_snippets(args.query, args.dir_name)
+    enumerate_snippets(args.query, args.dir_name, incremental=not args.renumber_snippets)
     
-    join_snippets_into_prompt(args.query, args.dir_name, run_name, args.num_snippets_in_prompt, config)
-    selected_genes_file_paths = select_genes(args.query, args.dir_name, run_name, args.gpt4_n, spec_filter=args.do_spec_filter)
+    if args.spec_index is not None:
+        init_spec_index(args.spec_index)
+    selected_genes_file_paths = select_genes(args.query, args.dir_name, run_name, args.gpt4_n, spec_filter=args.do_spec_filter, spec_ttl=args.spec_ttl, spec_workers=args.spec_workers, spec_batch=args.spec_batch)
+    # prompts are needed only for the genes that will be summarized
+    selected_gene_names = [os.path.splitext(x)[0] for x in selected_genes_file_paths]
+    duplicate_snippet_ids = None
+    if args.dedup_threshold > 0:
+        duplicate_snippet_ids = find_duplicate_snippets(args.query, args.dir_name, run_name, selected_gene_names, args.dedup_threshold)
+    join_snippets_into_prompt(args.query, args.dir_name, run_name, args.num_snippets_in_prompt, config, gene_names=selected_gene_names, token_budget=args.prompt_token_budget, packing=args.packing, exclude_snippet_ids=duplicate_snippet_ids, rank=args.rank_snippets)
     
     ''' Using GPT-4 API to make summaries '''
     if args.run_gpt:
-        if len(selected_genes_file_paths) > 0:
+        if args.prices is not None:
+            load_model_prices(args.prices)
+        init_pmid_cache(args.pmid_cache if args.pmid_cache is not None else f'{args.dir_name}/pmcid_to_pmid.jsonl')
+        if len(selected_genes_file_paths) > 0 and args.batch_dir is not None and not os.path.exists(get_gene_summaries_path(args.query, args.dir_name, run_name, args.gpt4_n, config['model'])):
+            add_genes_to_batch(args.batch_dir, args.query, args.dir_name, run_name, args.gpt4_n, config, args.text_output_dir_name)
+        elif len(selected_genes_file_paths) > 0:
     
             client = openai.OpenAI()
-            GPT_USAGE_1, gene_names, gpt4_responses = get_gpt_genes_response(client, args.query, args.dir_name, run_name, args.gpt4_n, config)
+            if args.llm_cache is not None:
+                init_response_cache(args.llm_cache, max_size_mb=args.llm_cache_size, bypass=args.llm_cache_bypass)
+            GPT_USAGE_1, gene_names, gpt4_responses = get_gpt_genes_response(client, args.query, args.dir_name, run_name, args.gpt4_n, config, max_chunks=args.map_reduce_chunks, num_workers=args.gpt_workers)
             GPT_USAGE_2, parsed_response, pmid_parsed_response = get_gpt_family_response(client, args.query, args.dir_name, run_name, gene_names, gpt4_responses, config, args.text_output_dir_name)
+            verbose_gpu_usage(GPT_USAGE_1, config, stage='genes')
+            verbose_gpu_usage(GPT_USAGE_2, config, stage='family')
+            save_gpu_usage(f'{args.dir_name}/{args.query}/{run_name}/usage.json', {'genes': GPT_USAGE_1, 'family': GPT_USAGE_2}, config, accumulate=True)
     
             print('*'*30 + args.query + '*'*30, f'\n{parsed_response}\n', '*'*79)
             print(f'\n{pmid_parsed_response}\n', '*'*79)
@@ -8,11 +8,19 @@ import json
 import os
 import argparse
 import pickle
+import threading
+from contextlib import closing
 import xml.etree.ElementTree as ET
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from utils_famfilter import make_spec_stats_file
+from utils_famfilter import iter_spec_stats
+from utils_rank import rank_snippets
+from utils_snippet_store import list_snippet_genes, read_gene_snippets, write_gene_snippets, get_all_gene_snippet_counts
+from utils_snippet_store import list_genes_without_snippet_ids
+from utils_snippet_store import write_paper_metadata, read_paper_metadata
+from utils_io import read_jsonl
 
 retries = Retry(total=5,
                 backoff_factor=0.1,
@@ -27,7 +35,7 @@ def get_dbname_from_acc(accession):
     if accession[:5] == 'G3DSA': return 'cathgene3d'
 
 
-def make_and_save_data(name, output_path, found_mentions):    
+def make_and_save_data(query, dir_name, gene_name, found_mentions, paper_metadata=None):    
     paper_nums, paper_ids, snippet_nums = [], [], []
     snippets = []
     for i, paper_id in enumerate(found_mentions):
@@ -44,8 +52,10 @@ def make_and_save_data(name, output_path, found_mentions):
         'snippet': snippets,
     })
     
-    df_domain_mentions.to_csv(output_path)
-    print(f'LOG: Saved snippets: {output_path}, found {len(snippets)} snippets')
+    write_gene_snippets(query, dir_name, gene_name, df_domain_mentions)
+    if paper_metadata is not None:
+        write_paper_metadata(query, dir_name, {paper_id: paper_metadata[paper_id] for paper_id in found_mentions if paper_id in paper_metadata})
+    print(f'LOG: Saved snippets for {gene_name}, found {len(snippets)} snippets')
 
 
 def mkdirsafe(path):
@@ -117,21 +127,146 @@ def get_intervals(idxs, window):
     return(coords)
 
 
-def parse_xml_response(domain_name, text, window):
+REGEX_SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+
+
+def iter_paragraph_texts(text, chunk_size=65536):
+    ''' Yields text of every <p> element of the full-text XML, in the same order as root.iter('p').
+        XML is parsed incrementally and parsed elements are cleared, so the element tree of the whole paper
+        is never built. The XML string itself is already in memory (see fetch_full_text_xml), so memory is
+        still linear in the size of the XML, only without the overhead of the tree.
+        Raises xml.etree.ElementTree.ParseError.
+    '''
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    p_depth = 0
+
+    def read_events():
+        nonlocal p_depth
+        for event, elem in parser.read_events():
+            if elem.tag != 'p':
+                # text inside paragraphs is needed until the outer paragraph ends
+                if event == 'end' and p_depth == 0:
+                    elem.clear()
+                continue
+            if event == 'start':
+                p_depth += 1
+                continue
+            p_depth -= 1
+            if p_depth == 0:
+                # nested paragraphs follow the outer one, like in root.iter('p')
+                for child in elem.iter('p'):
+                    yield ''.join(child.itertext())
+                elem.clear()
+
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i + chunk_size])
+        yield from read_events()
+    parser.close()
+    yield from read_events()
+
+
+def get_paper_text(text):
+    ''' Joins text of all paragraphs of the full-text XML. Returns None if XML can't be parsed '''
     try:
-        root = ET.fromstring(text)
-    except:
+        return ''.join([paragraph_text + '\n' for paragraph_text in iter_paragraph_texts(text)])
+    except ET.ParseError:
+        return None
+
+
+def get_snippets(all_text, idxs, window):
+    return [all_text[start:end] for (start, end) in get_intervals(idxs, window)]
+
+
+def stream_snippets(domain_name, paragraph_texts, window):
+    ''' Makes the same snippets as get_snippets would make for the mentions of domain_name
+        in the joined paragraph texts, without joining them. Of the paragraph text, only the part which can
+        still become a part of a snippet is kept (the XML which the paragraphs come from is not affected).
+        domain_name is matched case-insensitively and can't have regex special characters.
+    '''
+    pattern = re.compile(domain_name, flags=re.I)
+    name_len = len(domain_name)
+
+    # (position in the whole text, chunk of text)
+    chunks = deque()
+    text_len = 0
+    scan_pos = 0
+    # same interval bookkeeping as in get_intervals
+    cur_start_coord, cur_end_coord = -1, -1
+    closed_intervals = deque()
+    snippets = []
+
+    def get_text(start, end):
+        parts = []
+        for chunk_start, chunk in chunks:
+            if chunk_start + len(chunk) <= start:
+                continue
+            if chunk_start >= end:
+                break
+            parts.append(chunk[max(start - chunk_start, 0):end - chunk_start])
+        return ''.join(parts)
+
+    def get_tail(start):
+        parts = []
+        for chunk_start, chunk in reversed(chunks):
+            parts.append(chunk[max(start - chunk_start, 0):])
+            if chunk_start <= start:
+                break
+        return ''.join(reversed(parts))
+
+    for paragraph_text in paragraph_texts:
+        chunk = paragraph_text + '\n'
+        # mention can start in the end of the previous text
+        search_start = max(text_len - (name_len - 1), 0)
+        search_text = get_tail(search_start) + chunk
+        chunks.append((text_len, chunk))
+        text_len += len(chunk)
+
+        for m in pattern.finditer(search_text, max(scan_pos - search_start, 0)):
+            idx = search_start + m.start()
+            scan_pos = search_start + m.end()
+            idx_start = idx - window
+            idx_end = idx + window
+            if idx_start <= cur_end_coord:
+                cur_end_coord = idx_end
+            else:
+                if (cur_start_coord != -1 and cur_end_coord != -1):
+                    closed_intervals.append((cur_start_coord, cur_end_coord))
+                cur_start_coord = idx_start
+                cur_end_coord = idx_end
+
+        while len(closed_intervals) > 0 and closed_intervals[0][1] <= text_len:
+            start, end = closed_intervals.popleft()
+            snippets.append(get_text(start, end))
+
+        # text before keep_from can't be a part of any snippet
+        keep_from = text_len - (name_len - 1) - window
+        if len(closed_intervals) > 0:
+            keep_from = min(keep_from, closed_intervals[0][0])
+        if cur_start_coord != -1:
+            keep_from = min(keep_from, cur_start_coord)
+        while len(chunks) > 0 and chunks[0][0] + len(chunks[0][1]) <= keep_from:
+            chunks.popleft()
+
+    if (cur_start_coord != -1 and cur_end_coord != -1):
+        closed_intervals.append((cur_start_coord, cur_end_coord))
+    for (start, end) in closed_intervals:
+        snippets.append(get_text(start, end))
+    return snippets
+
+
+def parse_xml_response(domain_name, text, window):
+    if len(domain_name) > 0 and len(REGEX_SPECIAL_CHARS.intersection(domain_name)) == 0:
+        try:
+            return stream_snippets(domain_name, iter_paragraph_texts(text), window)
+        except ET.ParseError:
+            print('INFO: XML tree parsing error in gene name', domain_name)
+            return []
+
+    # gene name is used as a regex, its mentions can be of any length, so the whole text is needed
+    all_text = get_paper_text(text)
+    if all_text is None:
         print('INFO: XML tree parsing error in gene name', domain_name)
         return []
-        # raise xml.etree.ElementTree.ParseError
-
-    all_text = ''
-    selected_text = []
-    
-    for child in root.iter('p'):
-        text_content = ''.join(child.itertext())
-        all_text += text_content
-        all_text += '\n'
 
     try:
         idxs = [m.start() for m in re.finditer(domain_name, all_text, flags=re.I)]
@@ -140,15 +275,160 @@ def parse_xml_response(domain_name, text, window):
         return []
         # raise re.error
         
-    intervals = get_intervals(idxs, window)
-    for (start, end) in intervals:
-        selected_text.append(all_text[start:end])
-    return selected_text
+    return get_snippets(all_text, idxs, window)
+
+
+def make_trie_regex(words):
+    ''' Makes regex alternation of the words with common prefixes merged,
+        so that the regex engine checks every prefix only once.
+    '''
+    trie = dict()
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, dict())
+        node[''] = dict()
+
+    def node_to_regex(node):
+        alternatives = [re.escape(char) + node_to_regex(child) for char, child in node.items() if char != '']
+        if len(alternatives) == 0:
+            return ''
+        if len(alternatives) == 1 and '' not in node:
+            return alternatives[0]
+        return '(?:' + '|'.join(alternatives) + ')' + ('?' if '' in node else '')
+
+    return node_to_regex(trie)
+
+
+def compile_gene_matcher(gene_names):
+    ''' Prepares matching of many gene names in one pass over a text.
+        Literal gene names are merged into one compiled regex, which finds positions
+        where any of them starts. Gene names with regex special characters are
+        treated as regexes (the same way as in parse_xml_response) and matched separately.
+    '''
+    names_by_length = defaultdict(lambda: defaultdict(list))
+    regex_gene_names = []
+    for gene_name in gene_names:
+        if len(REGEX_SPECIAL_CHARS.intersection(gene_name)) == 0:
+            names_by_length[len(gene_name)][gene_name.lower()].append(gene_name)
+            continue
+        try:
+            re.compile(gene_name)
+        except re.error:
+            print('INFO: Regex error in gene name', gene_name)
+            continue
+        regex_gene_names.append(gene_name)
+
+    literals = [name for names in names_by_length.values() for name in names]
+    pattern = None
+    if len(literals) > 0:
+        pattern = re.compile('(?=' + make_trie_regex(sorted(literals)) + ')', flags=re.I)
+    return pattern, names_by_length, regex_gene_names
+
+
+def find_gene_mentions(all_text, window, matcher):
+    ''' Returns dictionary gene_name -> snippets for all genes of the matcher found in the text.
+        For every gene, mentions are the same as re.finditer would find for it alone.
+    '''
+    pattern, names_by_length, regex_gene_names = matcher
+    idxs = defaultdict(list)
+    last_end = dict()
+
+    if pattern is not None:
+        for m in pattern.finditer(all_text):
+            idx = m.start()
+            for length, names in names_by_length.items():
+                for gene_name in names.get(all_text[idx:idx + length].lower(), []):
+                    # mentions of one gene don't overlap, like in re.finditer
+                    if idx >= last_end.get(gene_name, 0):
+                        idxs[gene_name].append(idx)
+                        last_end[gene_name] = idx + length
+
+    for gene_name in regex_gene_names:
+        gene_idxs = [m.start() for m in re.finditer(gene_name, all_text, flags=re.I)]
+        if len(gene_idxs) > 0:
+            idxs[gene_name] = gene_idxs
+
+    return {gene_name: get_snippets(all_text, gene_idxs, window) for gene_name, gene_idxs in idxs.items()}
+
+
+def get_page_paper_ids(data, paper_metadata=None):
+    ''' Returns ids of the papers from one page of EuropePMC search results
+        which have full text available in EuropePMC.
+        If paper_metadata dictionary is given, PMID, DOI, title and year of these papers are added to it.
+    '''
+    paper_ids = []
+    for result in data['resultList']['result']:
+        if 'fullTextUrlList' in result:
+            url_list = result['fullTextUrlList']['fullTextUrl']
+            for elem in url_list:
+                doc_style = elem['documentStyle']
+                url = elem['url']
+                if doc_style == 'html' and url.find('europepmc.org') != -1:
+                    paper_id = url.split('/')[-1]
+                    paper_ids.append(paper_id)
+                    if paper_metadata is not None:
+                        paper_metadata[paper_id] = {'pmid': result.get('pmid'),
+                                                    'doi': result.get('doi'),
+                                                    'title': result.get('title'),
+                                                    'year': result.get('pubYear')}
+    # same paper can be listed several times, it is downloaded only once
+    return list(dict.fromkeys(paper_ids))
+
+
+def fetch_full_text_xml(paper_id, sess, xml_cache=None):
+    ''' Returns full-text XML of the paper or None if it is not available.
+        The whole XML is read into memory; with the cache, its bytes copy (decompressed or to be compressed) is held too.
+    '''
+    if xml_cache is not None:
+        data = xml_cache.get(paper_id)
+        if data is not None:
+            return data.decode('utf-8')
+        
+    r = sess.get(f'https://www.ebi.ac.uk/europepmc/webservices/rest/{paper_id}/fullTextXML')
+    # should i work with other types of status?
+    if r.status_code != 200:
+        return None
+    
+    if xml_cache is not None:
+        xml_cache.put(paper_id, r.text.encode('utf-8'))
+    return r.text
+
+
+def get_page_mentions(query, paper_ids, sess, snippet_window_size, executor=None, xml_cache=None):
+    ''' Downloads full texts for the papers of one search page and makes snippets.
+        If executor is given, downloads run concurrently and each paper is parsed
+        as soon as its XML arrives. Order of the papers is preserved.
+        Raises requests.exceptions.RetryError.
+    '''
+    mentions = dict()
+    
+    if executor is None:
+        for paper_id in paper_ids:
+            xml_text = fetch_full_text_xml(paper_id, sess, xml_cache)
+            if xml_text is not None:
+                mentions[paper_id] = parse_xml_response(query, xml_text, snippet_window_size)
+        return mentions
+
+    futures = {executor.submit(fetch_full_text_xml, paper_id, sess, xml_cache): paper_id for paper_id in paper_ids}
+    for future in as_completed(futures):
+        xml_text = future.result()
+        if xml_text is not None:
+            mentions[futures[future]] = parse_xml_response(query, xml_text, snippet_window_size)
+            
+    return {paper_id: mentions[paper_id] for paper_id in paper_ids if paper_id in mentions}
 
 
-def make_snippets(query, max_pages, snippet_window_size):
+def make_snippets(query, max_pages, snippet_window_size, num_workers=1, xml_cache=None, paper_metadata=None):
+    ''' Searches EuropePMC for the query and makes snippets from the full texts.
+        With num_workers > 1, full-text XMLs of a search page are downloaded concurrently,
+        together with the next search page.
+        xml_cache (utils_cache.DiskCache) is used to avoid downloading the same paper again.
+        Metadata of the found papers is added to paper_metadata dictionary (see get_page_paper_ids).
+        Returns None if EuropePMC requests failed.
+    '''
     sess = requests.Session()
-    sess.mount('https://', HTTPAdapter(max_retries=retries))
+    sess.mount('https://', HTTPAdapter(max_retries=retries, pool_maxsize=max(num_workers, 10)))
     
     found_mentions = dict()
     try:
@@ -168,36 +448,148 @@ def make_snippets(query, max_pages, snippet_window_size):
     
     if num_papers <= 0:
         return found_mentions
-    
-    for k in range(max_pages):
-        for i in range(len(data['resultList']['result'])):
-            if 'fullTextUrlList' in data['resultList']['result'][i]:
-                url_list =  data['resultList']['result'][i]['fullTextUrlList']['fullTextUrl']
-                for elem in url_list:
-                    doc_style = elem['documentStyle']
-                    url = elem['url']
-                    if doc_style == 'html' and url.find('europepmc.org') != -1:
-                        paper_id = url.split('/')[-1]
-                        try:
-                            r = sess.get(f'https://www.ebi.ac.uk/europepmc/webservices/rest/{paper_id}/fullTextXML')
-                        except requests.exceptions.RetryError:
-                            return None
+
+    executor = None
+    if num_workers > 1:
+        executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    try:
+        for k in range(max_pages):
+            next_page = None
+            if executor is not None and 'nextPageUrl' in data and k + 1 < max_pages:
+                next_page = executor.submit(sess.get, data['nextPageUrl'])
+
+            paper_ids = get_page_paper_ids(data, paper_metadata)
+            try:
+                found_mentions.update(get_page_mentions(query, paper_ids, sess, snippet_window_size, executor, xml_cache))
+            except requests.exceptions.RetryError:
+                return None
                             
-                        # should i work with other types of status?
-                        if r.status_code == 200:
-                            mentions = parse_xml_response(query, r.text, snippet_window_size)
-                            found_mentions[paper_id] = mentions
-                        
+            if 'nextPageUrl' in data:
+                try:
+                    if next_page is not None:
+                        rr = next_page.result()
+                    else:
+                        rr = sess.get(data['nextPageUrl'])
+                except requests.exceptions.RetryError:
+                    return None
+                data = rr.json()
+            else:
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return found_mentions
+
+
+def get_gene_paper_ids(query, max_pages, sess, paper_metadata=None):
+    ''' Returns ids of the papers found in EuropePMC for the query (only papers with full text),
+        or None if EuropePMC requests failed (any requests exception). Full texts are not downloaded.
+    '''
+    try:
+        # can return None
+        data = get_first_page(query, sess)
+    except requests.exceptions.RequestException:
+        return None
+
+    if data is None:
+        return None
+
+    if 'resultList' not in data:
+        print(f'INFO: no data from EuropePMC for query {query}!')
+        return []
+
+    paper_ids = []
+    for k in range(max_pages):
+        if len(data['resultList']['result']) == 0:
+            break
+        paper_ids += get_page_paper_ids(data, paper_metadata)
+        
         if 'nextPageUrl' in data:
             try:
                 rr = sess.get(data['nextPageUrl'])
-            except requests.exceptions.RetryError:
+                data = rr.json()
+            except requests.exceptions.RequestException:
                 return None
-            data = rr.json()
         else:
             break
+            
+    return list(dict.fromkeys(paper_ids))
 
-    return found_mentions
+
+# genes of a family are processed in blocks of this size, see make_family_snippets
+FAMILY_BLOCK_SIZE = 200
+
+
+def make_family_snippets(gene_names, max_pages, snippet_window_size, gene_workers=1, xml_workers=1, xml_cache=None, paper_metadata=None):
+    ''' Makes snippets for a block of genes of a family at once.
+        First, papers are searched for every gene. Then every paper is downloaded and parsed once,
+        and all the genes are found in it in a single pass. A gene gets snippets from all the papers
+        of the block mentioning it, including papers found by the search for other genes.
+        Returns dictionary gene_name -> found_mentions (same as make_snippets returns).
+        found_mentions is None for genes whose search failed or whose papers couldn't be downloaded,
+        other genes are not affected.
+    '''
+    sess = requests.Session()
+    sess.mount('https://', HTTPAdapter(max_retries=retries, pool_maxsize=max(gene_workers, xml_workers, 10)))
+
+    with ThreadPoolExecutor(max_workers=gene_workers) as executor:
+        searched_paper_ids = list(executor.map(lambda gene_name: get_gene_paper_ids(gene_name, max_pages, sess, paper_metadata), gene_names))
+    searched_paper_ids = dict(zip(gene_names, searched_paper_ids))
+    print(f'INFO: searched papers for {len(gene_names)} genes')
+
+    paper_ids = []
+    for gene_name in gene_names:
+        if searched_paper_ids[gene_name] is not None:
+            paper_ids += searched_paper_ids[gene_name]
+    paper_ids = list(dict.fromkeys(paper_ids))
+    print(f'INFO: {len(paper_ids)} unique papers to parse')
+
+    searched_genes = [gene_name for gene_name in gene_names if searched_paper_ids[gene_name] is not None]
+    matcher = compile_gene_matcher(searched_genes)
+
+    def get_paper_mentions(paper_id):
+        xml_text = fetch_full_text_xml(paper_id, sess, xml_cache)
+        if xml_text is None:
+            return None
+        all_text = get_paper_text(xml_text)
+        if all_text is None:
+            print('INFO: XML tree parsing error in paper', paper_id)
+            return dict()
+        return find_gene_mentions(all_text, snippet_window_size, matcher)
+
+    paper_mentions, failed_papers = dict(), set()
+    with ThreadPoolExecutor(max_workers=xml_workers) as executor:
+        futures = {executor.submit(get_paper_mentions, paper_id): paper_id for paper_id in paper_ids}
+        for future in as_completed(futures):
+            try:
+                paper_mentions[futures[future]] = future.result()
+            except requests.exceptions.RequestException:
+                failed_papers.add(futures[future])
+    if len(failed_papers) > 0:
+        print(f'WARNING: failed to download {len(failed_papers)} papers')
+
+    found_mentions_per_gene = dict()
+    for gene_name in gene_names:
+        gene_paper_ids = searched_paper_ids[gene_name]
+        # if any of the papers found for the gene can't be downloaded, gene search is treated as failed, like in make_snippets
+        if gene_paper_ids is None or len(failed_papers.intersection(gene_paper_ids)) > 0:
+            found_mentions_per_gene[gene_name] = None
+            continue
+            
+        gene_paper_ids = set(gene_paper_ids)
+        found_mentions = dict()
+        for paper_id in paper_ids:
+            if paper_id in failed_papers or paper_mentions[paper_id] is None:
+                continue
+            if gene_name in paper_mentions[paper_id]:
+                found_mentions[paper_id] = paper_mentions[paper_id][gene_name]
+            elif paper_id in gene_paper_ids:
+                found_mentions[paper_id] = []
+        found_mentions_per_gene[gene_name] = found_mentions
+        
+    return found_mentions_per_gene
 
 
 def save_gene_stats(query, dir, genes):
@@ -550,11 +942,55 @@ def get_per_gene_snippets_summary(query, dir_name, gene_list_filename=None):
     return data
     
 
-def get_save_gene_snippets(query, dir_name, max_pages_per_gene, snippet_window_size, force_flag, from_gene_list=False, gene_list_filename=None, max_genes_each_type=3000):
-    print('LOG: Started fetching gene snippets')
+def read_snippet_search_log(query, dir_name):
+    ''' Returns dictionary gene_name -> "success"/"fail" of the gene snippet search.
+        Progress is appended to the journal gene_snippet_search_log.jsonl and
+        merged into gene_snippet_search_log.json by compact_snippet_search_log.
+    '''
+    log_file = f'{dir_name}/{query}/gene_snippet_search_log.json'
+    journal_file = f'{dir_name}/{query}/gene_snippet_search_log.jsonl'
     
+    try:
+        with open(log_file, 'r') as f:
+            log_data = json.load(f)
+    except FileNotFoundError:
+        log_data = {}
+
+    for entry in read_jsonl(journal_file):
+        log_data[entry['gene_name']] = entry['status']
+        
+    return log_data
+
+
+def append_snippet_search_log(query, dir_name, gene_name, status):
+    journal_file = f'{dir_name}/{query}/gene_snippet_search_log.jsonl'
+    with open(journal_file, 'a') as f:
+        f.write(json.dumps({'gene_name': gene_name, 'status': status}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def compact_snippet_search_log(query, dir_name):
+    ''' Merges the journal into gene_snippet_search_log.json and removes it.
+        If the run breaks down in between, the journal is merged again next time, which gives the same result.
+    '''
     log_file = f'{dir_name}/{query}/gene_snippet_search_log.json'
+    journal_file = f'{dir_name}/{query}/gene_snippet_search_log.jsonl'
+    if not os.path.exists(journal_file):
+        return
+        
+    log_data = read_snippet_search_log(query, dir_name)
+    with open(log_file + '.tmp', 'w') as f:
+        json.dump(log_data, f, indent=4)
+    os.replace(log_file + '.tmp', log_file)
+    os.remove(journal_file)
+
+
+def get_save_gene_snippets(query, dir_name, max_pages_per_gene, snippet_window_size, force_flag, from_gene_list=False, gene_list_filename=None, max_genes_each_type=3000, xml_workers=1, gene_workers=1, xml_cache=None, family_extract=False):
+    print('LOG: Started fetching gene snippets')
+    
     snippets_path = f'{dir_name}/{query}/snippets_per_gene'
+    log_lock = threading.Lock()
 
     def get_genes_from_txt(from_gene_list=False):
         genes = dict({'reviewed': set(), 'unreviewed': set(), 'unknown_review_status': set()})
@@ -586,39 +1022,76 @@ def get_save_gene_snippets(query, dir_name, max_pages_per_gene, snippet_window_s
         return genes
     
     def log_progress(gene_name, status):
-        try:
-            with open(log_file, 'r') as f:
-                log_data = json.load(f)
-        except FileNotFoundError:
-            log_data = {}
-        
-        log_data[gene_name] = status
-        
-        with open(log_file, 'w') as f:
-            json.dump(log_data, f, indent=4)
+        # genes can be processed by several threads, journal is shared
+        with log_lock:
+            append_snippet_search_log(query, dir_name, gene_name, status)
 
     def verbose_progress():
-        try:
-            with open(log_file, 'r') as f:
-                log_data = json.load(f)
-                num_processed = len(log_data)
-                num_success = list(log_data.values()).count('success')
-                num_fail = list(log_data.values()).count('fail')
-                print(f'INFO: tried to process: {num_processed}, success: {num_success}, fail: {num_fail}.')
-        except:
+        log_data = read_snippet_search_log(query, dir_name)
+        if len(log_data) == 0:
             print('INFO: no gene snippet search log file yet')
+            return
+        num_processed = len(log_data)
+        num_success = list(log_data.values()).count('success')
+        num_fail = list(log_data.values()).count('fail')
+        print(f'INFO: tried to process: {num_processed}, success: {num_success}, fail: {num_fail}.')
     
     def get_processed_genes():
-        try:
-            with open(log_file, 'r') as f:
-                log_data = json.load(f)
-                return {gene_name for gene_name, status in log_data.items() if status == "success"}
-        except FileNotFoundError:
-            return set()
+        log_data = read_snippet_search_log(query, dir_name)
+        return {gene_name for gene_name, status in log_data.items() if status == "success"}
+
+    def save_gene_snippets(gene_name, found_mentions, paper_metadata):
+        if found_mentions is not None:
+            log_progress(gene_name, "success")
+        else:
+            log_progress(gene_name, "fail")
+            return
+        
+        num_snippets = sum([len(found_mentions[paper_id]) for paper_id in found_mentions])
+        if num_snippets > 0:
+            # can cause error btw :)
+            make_and_save_data(query, dir_name, gene_name, found_mentions=found_mentions, paper_metadata=paper_metadata)
+        else:
+            print(f'INFO: for {gene_name} found 0 snippets')
+
+    def process_gene(gene_name):
+        paper_metadata = dict()
+        found_mentions = make_snippets(query=gene_name,
+                                       max_pages=max_pages_per_gene,
+                                       snippet_window_size=snippet_window_size,
+                                       num_workers=xml_workers,
+                                       xml_cache=xml_cache,
+                                       paper_metadata=paper_metadata)
+        save_gene_snippets(gene_name, found_mentions, paper_metadata)
+
+    def process_genes_family(gene_names):
+        ''' Genes are processed in blocks: snippets and journal entries of a block are saved
+            as soon as its papers are parsed, so a broken run loses at most one block.
+        '''
+        for start in range(0, len(gene_names), FAMILY_BLOCK_SIZE):
+            block_gene_names = gene_names[start:start + FAMILY_BLOCK_SIZE]
+            print(f'INFO: family block of genes {start + 1}-{start + len(block_gene_names)} of {len(gene_names)}')
+            paper_metadata = dict()
+            found_mentions_per_gene = make_family_snippets(block_gene_names, max_pages_per_gene, snippet_window_size,
+                                                           gene_workers=gene_workers,
+                                                           xml_workers=xml_workers,
+                                                           xml_cache=xml_cache,
+                                                           paper_metadata=paper_metadata)
+            for gene_name in block_gene_names:
+                found_mentions = found_mentions_per_gene[gene_name]
+                save_gene_snippets(gene_name, found_mentions, paper_metadata)
+                # papers are shared by genes, metadata of each paper is saved once per block
+                if found_mentions is not None and sum([len(x) for x in found_mentions.values()]) > 0:
+                    for paper_id in found_mentions:
+                        paper_metadata.pop(paper_id, None)
 
     def process_genes(unique_gene_names_all, max_pages_per_gene, snippet_window_size, max_genes_each_type):
         ''' Main function for making snippets.
             Calls make_snippets function and logs progress.
+            With gene_workers > 1, genes are processed by a thread pool
+            (genes are still submitted in the same seeded order).
+            With family_extract, returns the genes to process instead,
+            they are processed together for all review statuses.
         '''
         unique_gene_names_all = list(unique_gene_names_all)[:max_genes_each_type]
         # filter names that will cause error!
@@ -627,11 +1100,13 @@ def get_save_gene_snippets(query, dir_name, max_pages_per_gene, snippet_window_s
         print(f'INFO: removed {len(unique_gene_names_all) - len(unique_gene_names)} genes with forward slash (/) in name.')
         
         processed_genes = get_processed_genes()
+        # one listing (or query) instead of a check per gene
+        genes_with_snippets = set(list_snippet_genes(query, dir_name))
         already_processed = 0
+        genes_to_process = []
     
         for gene_name in unique_gene_names:
-            output_path = snippets_path + '/' + gene_name + '.csv'
-            if os.path.exists(output_path):
+            if gene_name in genes_with_snippets:
                 # need to update status? I made a separate script for this
                 # print(f'INFO: Skipping {gene_name}: snippets already exist.')
                 already_processed += 1
@@ -640,34 +1115,19 @@ def get_save_gene_snippets(query, dir_name, max_pages_per_gene, snippet_window_s
                 # print(f"INFO: Skipping {gene_name}, already processed. Empty.")
                 already_processed += 1
                 continue
-            
-            found_mentions = make_snippets(query=gene_name,
-                                           max_pages=max_pages_per_gene,
-                                           snippet_window_size=snippet_window_size)
-            
-            if found_mentions is not None:
-                log_progress(gene_name, "success")
-            else:
-                log_progress(gene_name, "fail")
-                continue
-            
-            num_snippets = sum([len(found_mentions[paper_id]) for paper_id in found_mentions])
-            if num_snippets > 0:
-                # can cause error btw :)
-                make_and_save_data(gene_name, output_path=output_path, found_mentions=found_mentions)
-            else:
-                print(f'INFO: for {gene_name} found 0 snippets')
+            genes_to_process.append(gene_name)
         print(f'INFO: genes that were already processed for snippets: {already_processed}')
 
-    
-    def get_gene_snippet_info(gene_name):
-        num_papers, num_snippets = 0, 0
-        df_path = f'{dir_name}/{query}/snippets_per_gene/{gene_name}.csv'
-        if os.path.exists(df_path):
-            df = pd.read_csv(df_path)
-            num_papers = len(set(df['paper_id']))
-            num_snippets = len(df)
-        return num_papers, num_snippets
+        if family_extract:
+            return genes_to_process
+        if gene_workers > 1:
+            with ThreadPoolExecutor(max_workers=gene_workers) as executor:
+                # list() re-raises exceptions from the workers
+                list(executor.map(process_gene, genes_to_process))
+        else:
+            for gene_name in genes_to_process:
+                process_gene(gene_name)
+        return genes_to_process
 
     
     def make_summary():
@@ -675,9 +1135,7 @@ def get_save_gene_snippets(query, dir_name, max_pages_per_gene, snippet_window_s
             Used later.
         '''
         summary_info = []
-        gene_names_all = [x[:-4] for x in os.listdir(snippets_path)]
-        for gene_name in gene_names_all:
-            num_papers, num_snippets = get_gene_snippet_info(gene_name)
+        for gene_name, (num_papers, num_snippets) in get_all_gene_snippet_counts(query, dir_name).items():
             if num_papers > 0 and num_snippets > 0:
                 summary_info.append((gene_name, num_papers, num_snippets))
             
@@ -689,16 +1147,19 @@ def get_save_gene_snippets(query, dir_name, max_pages_per_gene, snippet_window_s
     
     genes = get_genes_from_txt(from_gene_list)
     
-    if (os.path.exists(snippets_path) and len(os.listdir(snippets_path)) != 0):
+    num_genes_with_snippets = len(list_snippet_genes(query, dir_name))
+    if num_genes_with_snippets != 0:
         if not force_flag:
-            num_genes_with_snippets = len(os.listdir(snippets_path))
-            print(f'Snippets already exist ({num_genes_with_snippets} files). Not making snippets again')
+            print(f'Snippets already exist ({num_genes_with_snippets} genes). Not making snippets again')
             return num_genes_with_snippets
         else:
             print('INFO: Snippets exist, but forced to make them again. Info: new files can be created, existing files will not be altered.')
 
     mkdirsafe(snippets_path)
+    # journal could be left by a run that broke down
+    compact_snippet_search_log(query, dir_name)
     verbose_progress()
+    family_genes = []
     
     for protein_type in ['reviewed', 'unreviewed', 'unknown_review_status']:
         print(f"INFO: Working with: {protein_type} proteins")
@@ -709,19 +1170,32 @@ def get_save_gene_snippets(query, dir_name, max_pages_per_gene, snippet_window_s
             random.shuffle(unique_gene_names)
             
             print(f'INFO: found {len(unique_gene_names)} unique gene names of type {protein_type}')
-            process_genes(unique_gene_names, max_pages_per_gene, snippet_window_size, max_genes_each_type)
+            family_genes += process_genes(unique_gene_names, max_pages_per_gene, snippet_window_size, max_genes_each_type)
+
+    if family_extract:
+        # same gene name can have several review statuses
+        family_genes = list(dict.fromkeys(family_genes))
+        print(f'INFO: Making snippets for {len(family_genes)} genes, each paper is parsed once')
+        process_genes_family(family_genes)
     
+    compact_snippet_search_log(query, dir_name)
     print('INFO: gene snippet search completed successfully')
+    if xml_cache is not None:
+        xml_cache.verbose_stats('full-text XML cache')
 
     make_summary()
     
-    num_genes_with_snippets = len(os.listdir(snippets_path))
-    print(f'INFO: Total {len(os.listdir(snippets_path))} genes with snippets.')
+    num_genes_with_snippets = len(list_snippet_genes(query, dir_name))
+    print(f'INFO: Total {num_genes_with_snippets} genes with snippets.')
     
     return num_genes_with_snippets
 
 
-def enumerate_snippets(query, dir_name):
+def enumerate_snippets(query, dir_name, incremental=True):
+    ''' Adds snippet IDs {paper_id}_{number of the snippet in the paper} to the snippets.
+        With incremental=True, only genes which were added since the last enumeration get IDs,
+        IDs of other genes stay the same and their snippets are not rewritten.
+    '''
     # renaming columns
     def adjust_column_names(df):
         try:
@@ -736,40 +1210,61 @@ def enumerate_snippets(query, dir_name):
         df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
             
         return df
+
+    def load_mapping(name):
+        with open(f"{dir_name}/{query}/tmp/{name}.json", "r") as json_file:
+            return json.load(json_file)
     
-    snippets_path = f'{dir_name}/{query}/snippets_per_gene'
-    file_names = os.listdir(snippets_path)
-    file_names = [x for x in file_names if x[0] != '.']
+    gene_names = list_snippet_genes(query, dir_name)
 
     paper_to_cnt = defaultdict(int)
     snippet_id_to_gene = dict()
     paper_to_genes = dict()
 
-    for file_name in file_names:
-        snippet_file_path = snippets_path + '/' + file_name
-        df = pd.read_csv(snippet_file_path)
+    if incremental:
+        try:
+            snippet_id_to_gene = load_mapping('snippet_id_to_gene')
+            paper_to_genes = load_mapping('paper_to_genes')
+            paper_to_cnt.update(load_mapping('paper_to_cnt'))
+        except FileNotFoundError:
+            print('INFO: no previous snippet enumeration found, enumerating all snippets')
+            paper_to_cnt = defaultdict(int)
+            snippet_id_to_gene = dict()
+            paper_to_genes = dict()
+
+    enumerated_genes = set(snippet_id_to_gene.values())
+    # genes whose snippets were rewritten after enumeration (e.g. searched again with -F) lost their IDs
+    rewritten_genes = enumerated_genes.intersection(list_genes_without_snippet_ids(query, dir_name))
+    if len(rewritten_genes) > 0:
+        print(f'INFO: {len(rewritten_genes)} genes have new snippets since the last enumeration, their old snippet IDs are dropped')
+        snippet_id_to_gene = {x: y for x, y in snippet_id_to_gene.items() if y not in rewritten_genes}
+        paper_to_genes = {x: [y for y in genes if y not in rewritten_genes] for x, genes in paper_to_genes.items()}
+        paper_to_genes = {x: genes for x, genes in paper_to_genes.items() if len(genes) > 0}
+        # paper counters are not decreased, so new IDs never repeat the old ones
+        enumerated_genes -= rewritten_genes
+    new_gene_names = [gene_name for gene_name in gene_names if gene_name not in enumerated_genes]
+    print(f'INFO: {len(gene_names) - len(new_gene_names)} genes already have snippet IDs, enumerating {len(new_gene_names)} genes')
+    if len(new_gene_names) == 0:
+        return
+
+    for gene_name in new_gene_names:
+        df = read_gene_snippets(query, dir_name, gene_name)
         df = adjust_column_names(df)
-        
-        gene_name = os.path.splitext(file_name)[0]
-        snippet_ids = []
-        
-        for i, row in df.iterrows():
-            paper_id = row['paper_id']
-            
+
+        # counters continue from the snippets of the previous genes
+        paper_ids = df['paper_id'].astype(str)
+        snippet_nums_in_paper = paper_ids.map(paper_to_cnt).fillna(0).astype(int) + paper_ids.groupby(paper_ids).cumcount()
+        snippet_ids = paper_ids + '_' + snippet_nums_in_paper.astype(str)
+
+        for paper_id, cnt in paper_ids.groupby(paper_ids, sort=False).size().items():
+            paper_to_cnt[paper_id] += cnt
             if paper_id not in paper_to_genes:
                 paper_to_genes[paper_id] = []
-            paper_to_genes[paper_id].append(gene_name)
-            
-            paper_snippet_counter = paper_to_cnt[paper_id]
-            paper_to_cnt[paper_id] += 1
-            
-            snippet_id = f'{paper_id}_{paper_snippet_counter}'
-            snippet_ids.append(snippet_id)
-            
-            snippet_id_to_gene[snippet_id] = gene_name
+            paper_to_genes[paper_id] += [gene_name] * cnt
+        snippet_id_to_gene.update(dict.fromkeys(snippet_ids, gene_name))
             
-        df.insert(2, 'snippet_id', snippet_ids)
-        df.to_csv(snippet_file_path)
+        df.insert(2, 'snippet_id', list(snippet_ids))
+        write_gene_snippets(query, dir_name, gene_name, df)
             
     with open(f"{dir_name}/{query}/tmp/snippet_id_to_gene.json", "w") as json_file:
         json.dump(snippet_id_to_gene, json_file, indent=4)
@@ -800,100 +1295,178 @@ def remove_citations(text):
     return cleaned_text
 
 
-def join_snippets_into_prompt(query, dir_name, run_name, N, config):
-    snippets_path = f'{dir_name}/{query}/snippets_per_gene'
+def approx_tokens(text):
+    return (len(text) + 3) // 4
+
+
+def get_token_counter(model, required=False):
+    ''' Returns function which counts tokens in a text with the local tokenizer of the model (tiktoken)
+        and whether the counts are exact. If tiktoken or its encoding is not available, raises RuntimeError
+        with required=True, otherwise tokens are approximated as characters / 4.
+    '''
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding('o200k_base')
+    except Exception as e:
+        if required:
+            raise RuntimeError(f'tiktoken tokenizer for {model} is not available ({repr(e)}), it is needed for the prompt token budget') from e
+        print('WARNING: tiktoken tokenizer is not available, number of tokens is approximated as characters / 4')
+        return approx_tokens, False
+    return (lambda text: len(encoding.encode(text, disallowed_special=()))), True
+
+
+def pack_snippets(entries, entry_tokens, token_budget, strategy='greedy'):
+    ''' Splits snippet entries into parts, so that each part has no more than token_budget tokens.
+        "greedy": entries are added in their order, new part is started when the current one is full.
+        "first-fit": each entry goes to the first part with enough space left, so gaps are filled
+        by later (smaller) entries; earlier entries still go to earlier parts.
+        Entry which is larger than the budget gets a part of its own.
+    '''
+    parts, parts_tokens = [], []
+    for entry, n_tokens in zip(entries, entry_tokens):
+        if n_tokens > token_budget:
+            print(f'WARNING: snippet has {n_tokens} tokens, more than prompt token budget allows ({token_budget})')
+            
+        if strategy == 'first-fit':
+            candidates = range(len(parts))
+        elif strategy == 'greedy':
+            candidates = range(max(len(parts) - 1, 0), len(parts))
+        else:
+            raise Exception(f"ERROR: Unknown packing strategy {strategy}")
+            
+        for k in candidates:
+            if parts_tokens[k] + n_tokens <= token_budget:
+                parts[k].append(entry)
+                parts_tokens[k] += n_tokens
+                break
+        else:
+            parts.append([entry])
+            parts_tokens.append(n_tokens)
+    return parts
+
+
+# in "prefix" prompt layout instructions don't contain the gene name, so they are the same for all genes
+GENE_PLACEHOLDER = 'the target gene'
+# same for the number of genes in family instructions
+NUM_GENES_PLACEHOLDER = 'several'
+
+
+def get_prompt_layout(config):
+    ''' "default": instructions around the variable content (snippets, summaries),
+        "prefix": constant instructions first and variable content last, so providers can reuse the cached prefix
+    '''
+    layout = config.get('prompt_layout', 'default')
+    if layout not in ('default', 'prefix'):
+        raise ValueError(f'Unknown prompt_layout {layout} in config, must be "default" or "prefix"')
+    return layout
+
+
+def join_snippets_into_prompt(query, dir_name, run_name, N, config, gene_names=None, token_budget=0, packing='greedy', exclude_snippet_ids=None, rank=False):
+    ''' Makes prompts for gene summaries and saves them to the run directory.
+        If gene_names is given (e.g. genes returned by select_genes), prompts are made only for these genes,
+        otherwise for all genes with snippets.
+        Snippets are split into prompts by N snippets per prompt, or, if token_budget > 0,
+        they are packed into prompts of up to token_budget tokens (see pack_snippets).
+        Snippets from exclude_snippet_ids (e.g. near duplicates) are not used.
+        With rank=True, snippets are sorted by relevance (BM25, see utils_rank.py), so the best ones go first.
+    '''
     save_path = f'{dir_name}/{query}/{run_name}/per_gene_joined_prompts_dirty'
         
     mkdirsafe(save_path)
+
+    if gene_names is None:
+        gene_names = list_snippet_genes(query, dir_name)
+
+    if token_budget > 0:
+        # packing into the token budget needs exact counts
+        count_tokens, _ = get_token_counter(config['model'], required=True)
+        tokens_column = 'num_tokens'
+    else:
+        # tiktoken isn't loaded: it can download its encoding, which fails or waits on nodes without network
+        count_tokens, tokens_column = approx_tokens, 'num_tokens_approx'
+    layout = get_prompt_layout(config)
+
+    if config['instr_2_gene_temp'].find('file:') != -1:
+        with open(config['instr_2_gene_temp'][5:], 'r') as f:
+            instr_2_fam_temp = f.read()
+    else:
+        instr_2_fam_temp = config['instr_2_gene_temp']
     
-    file_names = os.listdir(snippets_path)
-    file_names = [x for x in file_names if x[0] != '.']
-    
-    for file_name in file_names:
-        gene_name = os.path.splitext(file_name)[0]
-        df = pd.read_csv(snippets_path + '/' + file_name)
-        
-        instr_1 = config['instr_1_gene_temp'].format(gene_name)
+    for gene_name in gene_names:
+        df = read_gene_snippets(query, dir_name, gene_name)
+        if exclude_snippet_ids is not None:
+            df = df[~df['snippet_id'].isin(exclude_snippet_ids)]
+        if rank:
+            df = rank_snippets(df, gene_name, config)
         
-        if config['instr_2_gene_temp'].find('file:') != -1:
-            with open(config['instr_2_gene_temp'][5:], 'r') as f:
-                instr_2_fam_temp = f.read()
+        if layout == 'prefix':
+            header = config['instr_1_gene_temp'].format(GENE_PLACEHOLDER) + '\n' + instr_2_fam_temp.format(GENE_PLACEHOLDER) + '\n' + '\n' + f'Target gene: {gene_name}\n'
+            footer = ''
         else:
-            instr_2_fam_temp = config['instr_2_gene_temp']
-            
-        instr_2 = instr_2_fam_temp.format(gene_name)
-    
-        prompts, n_chars, n_snippets = [], [], []
-        part = ''
-        i = 0
+            header = config['instr_1_gene_temp'].format(gene_name) + '\n'
+            footer = '\n' + instr_2_fam_temp.format(gene_name)
 
-        for j, row in df.iterrows():
-            snippet, snippet_id = row['snippet'], row['snippet_id']
+        entries = []
+        for snippet, snippet_id in zip(df['snippet'], df['snippet_id']):
             snippet = remove_citations(snippet)
-            i += 1
-            data = '{' + 'ID: ' + snippet_id + ',\n' + 'Content: ' + snippet + '}\n'
-            part += data
-            
-            if i == N:
-                prompt = instr_1 + '\n' + part + '\n' + instr_2
-                prompts.append(prompt)
-                n_chars.append(len(prompt))
-                n_snippets.append(N)
-                part = ''
-                i = 0
-        
-        if len(part) > 0:
-            prompt = instr_1 + '\n' + part  + '\n' + instr_2
+            entries.append('{' + 'ID: ' + snippet_id + ',\n' + 'Content: ' + snippet + '}\n')
+
+        if token_budget > 0:
+            instr_tokens = count_tokens(header + footer)
+            if instr_tokens >= token_budget:
+                raise ValueError(f'Prompt token budget {token_budget} is not larger than the instructions of gene {gene_name} ({instr_tokens} tokens)')
+            entry_tokens = [count_tokens(entry) for entry in entries]
+            parts = pack_snippets(entries, entry_tokens, token_budget - instr_tokens, strategy=packing)
+        else:
+            parts = [entries[i:i + N] for i in range(0, len(entries), N)]
+    
+        prompts, n_chars, n_snippets, n_tokens = [], [], [], []
+        for part in parts:
+            prompt = header + ''.join(part) + footer
             prompts.append(prompt)
             n_chars.append(len(prompt))
-            n_snippets.append(i)
+            n_snippets.append(len(part))
+            n_tokens.append(count_tokens(prompt))
         
         df_prompts = pd.DataFrame({'prompt': prompts,
                                    'num_chars': n_chars,
-                                   'num_snippets': n_snippets
+                                   'num_snippets': n_snippets,
+                                   tokens_column: n_tokens
                                   })
 
         
         fname = f'{save_path}/{gene_name}.csv'
         df_prompts.to_csv(fname)
 
-    print('INFO: Joined snippets into prompts using config')
+    print(f'INFO: Joined snippets into prompts using config for {len(gene_names)} genes')
 
 
-def select_genes(query, dir_name, run_name, N, TH_GOOD=0.5, TH_BAD=0.15, spec_filter=True):
+def select_genes(query, dir_name, run_name, N, TH_GOOD=0.5, TH_BAD=0.15, spec_filter=True, spec_ttl=30, spec_workers=4, spec_batch=1):
     if not spec_filter:
         print('INFO: Specificity filter turned OFF')
         
     def fam_filter(gene_names, snippet_stats):
+        ''' Genes are checked in priority order, specificity is computed only until N genes pass (see iter_spec_stats) '''
         result = []
-        gene_stat_dict = dict()
         
         selected_genes_filename = f'{dir_name}/{query}/{run_name}/selected_genes.txt'
         selected_genes_file = open(selected_genes_filename, 'w')
     
-        spec_stats_filename = f'{dir_name}/{query}/tmp/gene_spec_stats.tsv'
-        # if not os.path.exists(spec_stats_filename):
-        make_spec_stats_file(dir_name, query)
-        
-        with open(spec_stats_filename, 'r') as f:
-            for line in f:
-                line = line.strip().split('\t')
-                gene_name, all_hits_total, value_true, value_false = line
-                all_hits_total = int(all_hits_total)
-                value_true = float(value_true)
-                value_false = float(value_false)
-                gene_stat_dict[gene_name] = (all_hits_total, value_true, value_false)
-            
-        for gene_name in gene_names:
-            if gene_name not in gene_stat_dict:
-                continue
-            all_hits_total, value_true, value_false = gene_stat_dict[gene_name]
-            
-            if (not spec_filter) or (value_true >= 0.5 and value_false <= 0.2) or (value_false < 0.01 and value_true > 0.1):
-                result.append(gene_name)
-                print(f'{gene_name}\t{all_hits_total}\t{value_true}\t{value_false}\t{snippet_stats[gene_name][0]}\t{snippet_stats[gene_name][1]}\t{snippet_stats[gene_name][2]}', file=selected_genes_file)
-                if len(result) >= N:
-                    break
+        with closing(iter_spec_stats(dir_name, query, gene_names, ttl_days=spec_ttl, num_workers=spec_workers, batch_size=spec_batch)) as spec_stats:
+            for gene_name, record in spec_stats:
+                if record is None or record['status'] != 'ok':
+                    continue
+                # same precision as in gene_spec_stats.tsv
+                all_hits_total, value_true, value_false = record['all_hits_total'], round(record['prop_true'], 2), round(record['prop_false'], 2)
+                
+                if (not spec_filter) or (value_true >= 0.5 and value_false <= 0.2) or (value_false < 0.01 and value_true > 0.1):
+                    result.append(gene_name)
+                    print(f'{gene_name}\t{all_hits_total}\t{value_true}\t{value_false}\t{snippet_stats[gene_name][0]}\t{snippet_stats[gene_name][1]}\t{snippet_stats[gene_name][2]}', file=selected_genes_file)
+                    if len(result) >= N:
+                        break
                 
         selected_genes_file.close()
         print('INFO: Created gene selection file', selected_genes_filename)
@@ -947,11 +1520,10 @@ def find_citations(text):
 def get_snippet_dict_by_gene_name(query, dir_name, gene_name):
     ''' Returns dictionary snippet_id -> snippet text for a specified gene name'''
     
-    snippets_path = f'{dir_name}/{query}/snippets_per_gene/{gene_name}.csv'
-    if not os.path.exists(snippets_path):
-        raise Exception(f"Snippet path error: file {snippets_path} doesnt exist")
-        
-    df_snippets = pd.read_csv(snippets_path)
+    try:
+        df_snippets = read_gene_snippets(query, dir_name, gene_name)
+    except FileNotFoundError:
+        raise Exception(f"Snippet path error: no snippets for gene {gene_name}")
     snippet_dict = dict(zip(df_snippets['snippet_id'], df_snippets['snippet']))
     return snippet_dict
 
@@ -967,6 +1539,9 @@ def make_factcheck_df(query, dir_name, snippet_ids_, gene_names_, snippet_conten
     
     df['paper_id'] = df['snippet_id'].str.split('_').str[0]
     df.insert(1, 'paper_id', df.pop('paper_id'))
+    paper_metadata = read_paper_metadata(query, dir_name)
+    df.insert(2, 'pmid', df['paper_id'].map(lambda x: paper_metadata.get(x, {}).get('pmid')))
+    df.insert(3, 'doi', df['paper_id'].map(lambda x: paper_metadata.get(x, {}).get('doi')))
     df['snippet_error'] = df['snippet'].str.startswith('ERROR', na=False)
     
     df.drop_duplicates(inplace=True)
@@ -0,0 +1,312 @@
+''' Batch API mode for gene summaries of many families.
+
+    1. main_gene_annot.py with -batch-dir DIR and -run-gpt 1 prepares gene prompts of the family as usual,
+       but adds the gene summarization requests to DIR instead of calling the API (one request file per family run).
+    2. python utils_batch.py submit -batch-dir DIR uploads all new requests and creates batch jobs
+       (big request sets are split into several jobs).
+    3. python utils_batch.py wait -batch-dir DIR polls the jobs until they finish and collects the results:
+       gene summaries are written to per_gene_summaries_*.csv of each family run, and family summaries are
+       made with get_gpt_family_response (use -family 0 to skip them).
+       Requests of the genes which failed are queued again (up to MAX_BATCH_ATTEMPTS attempts) and wait submits them;
+       the family summary of a run is made when all its genes are collected.
+       Family summaries can also be made later by running main_gene_annot.py again with -run-name of the run:
+       existing gene summaries are never requested again.
+    Batch mode uses only the first prompt of each gene (-mr is not supported).
+'''
+
+import os
+import json
+import time
+import hashlib
+import argparse
+import pandas as pd
+import openai
+
+from utils import get_selected_genes_filepaths
+from utils_gpt import make_gene_messages, parse_response, get_gpt_genes_response, get_gpt_family_response
+from utils_gpt import init_gpu_usage, get_call_usage, add_gpu_usage, verbose_gpu_usage, save_gpu_usage, load_model_prices, init_pmid_cache, BATCH_PRICE_FACTOR
+
+
+# limits of one batch job
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+# requests of the failed genes are submitted again up to this number of attempts in total
+MAX_BATCH_ATTEMPTS = 3
+
+
+def get_batch_state_path(batch_dir):
+    return f'{batch_dir}/batches.json'
+
+
+def read_batch_state(batch_dir):
+    ''' Returns list of submitted batch jobs: {"id", "input_path", "request_files", "status", "collected"} '''
+    if not os.path.exists(get_batch_state_path(batch_dir)):
+        return []
+    with open(get_batch_state_path(batch_dir), 'r') as f:
+        return json.load(f)
+
+
+def write_batch_state(batch_dir, batches):
+    tmp_path = get_batch_state_path(batch_dir) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(batches, f, indent=1)
+    os.replace(tmp_path, get_batch_state_path(batch_dir))
+
+
+def get_run_key(query, dir_name, run_name):
+    return hashlib.sha1(f'{dir_name}/{query}/{run_name}'.encode()).hexdigest()[:16]
+
+
+def get_gene_summaries_path(query, dir_name, run_name, gpt4_n, model):
+    # same file as in get_gpt_genes_response
+    return f'{dir_name}/{query}/{run_name}/per_gene_summaries_{model}_sample_{gpt4_n}_4o.csv'
+
+
+def add_genes_to_batch(batch_dir, query, dir_name, run_name, gpt4_n, config, text_output_dir_name):
+    ''' Writes gene summarization requests of the family run to the batch directory.
+        Preparing the same run again replaces its requests (unless they are already submitted).
+    '''
+    os.makedirs(f'{batch_dir}/requests', exist_ok=True)
+    os.makedirs(f'{batch_dir}/manifests', exist_ok=True)
+
+    prefix = f'{dir_name}/{query}/{run_name}/per_gene_joined_prompts_dirty'
+    run_key = get_run_key(query, dir_name, run_name)
+    gene_names, custom_ids = [], []
+
+    tmp_path = f'{batch_dir}/requests/.{run_key}.jsonl.tmp'
+    with open(tmp_path, 'w') as f:
+        for i, query_path in enumerate(get_selected_genes_filepaths(query, dir_name, run_name, gpt4_n)):
+            df = pd.read_csv(prefix + '/' + query_path)
+            custom_id = f'{run_key}_{i}'
+            request = {'custom_id': custom_id,
+                       'method': 'POST',
+                       'url': '/v1/chat/completions',
+                       'body': {'model': config['model'], 'messages': make_gene_messages(list(df['prompt'])[0], config)}
+                      }
+            print(json.dumps(request), file=f)
+            gene_names.append(os.path.splitext(query_path)[0])
+            custom_ids.append(custom_id)
+
+    manifest = {'query': query, 'dir_name': dir_name, 'run_name': run_name, 'gpt4_n': gpt4_n,
+                'text_output_dir_name': text_output_dir_name, 'config': config,
+                'gene_names': gene_names, 'custom_ids': custom_ids}
+    with open(f'{batch_dir}/manifests/{run_key}.json', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, f'{batch_dir}/requests/{run_key}.jsonl')
+
+    print(f'INFO: {len(gene_names)} gene requests of {query} ({run_name}) added to batch directory {batch_dir}')
+
+
+def get_pending_request_files(batch_dir):
+    submitted = set(x for batch in read_batch_state(batch_dir) for x in batch['request_files'])
+    requests_dir = f'{batch_dir}/requests'
+    if not os.path.exists(requests_dir):
+        return []
+    return sorted([x for x in os.listdir(requests_dir) if x[0] != '.' and x.endswith('.jsonl') and x not in submitted])
+
+
+def split_request_files(batch_dir, request_files):
+    ''' Groups request files into batch inputs within the job limits. Requests of one family run stay in one job. '''
+    groups, group, num_requests, num_bytes = [], [], 0, 0
+    for request_file in request_files:
+        path = f'{batch_dir}/requests/{request_file}'
+        file_bytes = os.path.getsize(path)
+        with open(path, 'r') as f:
+            file_requests = sum(1 for _ in f)
+        if len(group) > 0 and (num_requests + file_requests > MAX_BATCH_REQUESTS or num_bytes + file_bytes > MAX_BATCH_BYTES):
+            groups.append(group)
+            group, num_requests, num_bytes = [], 0, 0
+        group.append(request_file)
+        num_requests += file_requests
+        num_bytes += file_bytes
+    if len(group) > 0:
+        groups.append(group)
+    return groups
+
+
+def submit_batches(client, batch_dir):
+    batches = read_batch_state(batch_dir)
+    request_files = get_pending_request_files(batch_dir)
+    if len(request_files) == 0:
+        print('INFO: No new requests to submit')
+        return
+
+    for group in split_request_files(batch_dir, request_files):
+        input_path = f'{batch_dir}/batch_input_{len(batches)}.jsonl'
+        with open(input_path, 'w') as f_out:
+            for request_file in group:
+                with open(f'{batch_dir}/requests/{request_file}', 'r') as f_in:
+                    f_out.write(f_in.read())
+
+        with open(input_path, 'rb') as f:
+            input_file = client.files.create(file=f, purpose='batch')
+        batch = client.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions', completion_window='24h')
+        batches.append({'id': batch.id, 'input_path': input_path, 'request_files': group, 'status': batch.status, 'collected': False})
+        # saved after every job, so jobs are not submitted twice if submission breaks
+        write_batch_state(batch_dir, batches)
+        print(f'INFO: Submitted batch {batch.id} with requests of {len(group)} family runs')
+
+
+def read_batch_output(client, file_id):
+    ''' Returns dictionary custom_id -> response body (only successful requests) '''
+    responses = dict()
+    if file_id is None:
+        return responses
+    for line in client.files.content(file_id).text.splitlines():
+        if len(line.strip()) == 0:
+            continue
+        record = json.loads(line)
+        response = record.get('response')
+        if record.get('error') is None and response is not None and response.get('status_code') == 200:
+            responses[record['custom_id']] = response['body']
+    return responses
+
+
+def requeue_failed_requests(batch_dir, request_file, manifest, failed_custom_ids):
+    ''' Writes requests of the failed genes to a new request file, which is submitted with the next submit.
+        Returns False if the run has used up its attempts.
+    '''
+    attempt = manifest.get('attempt', 0) + 1
+    if attempt >= MAX_BATCH_ATTEMPTS:
+        return False
+
+    run_key = get_run_key(manifest['query'], manifest['dir_name'], manifest['run_name'])
+    retry_name = f'{run_key}_r{attempt}'
+    with open(f'{batch_dir}/requests/{request_file}', 'r') as f:
+        lines = [line for line in f if json.loads(line)['custom_id'] in failed_custom_ids]
+
+    retry_manifest = dict(manifest, attempt=attempt)
+    retry_manifest['gene_names'] = [x for x, y in zip(manifest['gene_names'], manifest['custom_ids']) if y in failed_custom_ids]
+    retry_manifest['custom_ids'] = [y for y in manifest['custom_ids'] if y in failed_custom_ids]
+    with open(f'{batch_dir}/manifests/{retry_name}.json', 'w') as f:
+        json.dump(retry_manifest, f, indent=1)
+    tmp_path = f'{batch_dir}/requests/.{retry_name}.jsonl.tmp'
+    with open(tmp_path, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp_path, f'{batch_dir}/requests/{retry_name}.jsonl')
+    return True
+
+
+def distribute_gene_summaries(batch_dir, request_file, responses):
+    ''' Writes gene summaries of one family run (only the genes with responses, added to the summaries saved before).
+        Requests of the failed genes are queued again (see requeue_failed_requests).
+        Returns its manifest, usage of its requests and number of failed genes.
+    '''
+    with open(f'{batch_dir}/manifests/{request_file[:-6]}.json', 'r') as f:
+        manifest = json.load(f)
+    query, dir_name, run_name, gpt4_n = manifest['query'], manifest['dir_name'], manifest['run_name'], manifest['gpt4_n']
+
+    GPT_USAGE = init_gpu_usage(price_factor=BATCH_PRICE_FACTOR)
+    summaries, failed_gene_names, failed_custom_ids = dict(), [], set()
+    for gene_name, custom_id in zip(manifest['gene_names'], manifest['custom_ids']):
+        if custom_id not in responses:
+            failed_gene_names.append(gene_name)
+            failed_custom_ids.add(custom_id)
+            continue
+        # prompt length isn't known here, usage has the token counts
+        add_gpu_usage(GPT_USAGE, get_call_usage(responses[custom_id]), 0)
+        summaries[gene_name] = parse_response(responses[custom_id])
+
+    summaries_path = get_gene_summaries_path(query, dir_name, run_name, gpt4_n, manifest['config']['model'])
+    if os.path.exists(summaries_path):
+        # summaries of the earlier attempts
+        df = pd.read_csv(summaries_path, index_col=0)
+        summaries = dict(zip(df['gene_name'], df['response']), **summaries)
+    if len(summaries) > 0:
+        # same order as in get_gpt_genes_response
+        selected_gene_names = [os.path.splitext(x)[0] for x in get_selected_genes_filepaths(query, dir_name, run_name, gpt4_n)]
+        gene_names = [x for x in selected_gene_names if x in summaries]
+        df = pd.DataFrame({'gene_name': gene_names,
+                           'response': [summaries[x] for x in gene_names]})
+        df.to_csv(summaries_path)
+    print(f'INFO: {query} ({run_name}): {len(manifest["gene_names"]) - len(failed_gene_names)} gene summaries saved')
+
+    if len(failed_gene_names) > 0:
+        print(f'WARNING: {len(failed_gene_names)} genes of {query} ({run_name}) failed:', ', '.join(failed_gene_names))
+        if requeue_failed_requests(batch_dir, request_file, manifest, failed_custom_ids):
+            print('INFO: Their requests are queued again, run submit to send them. The family summary is made when they are collected')
+        else:
+            print(f'WARNING: {MAX_BATCH_ATTEMPTS} attempts failed, the family summary is not made. '
+                  f'Run main_gene_annot.py with -run-name {run_name} without -batch-dir to request the missing genes')
+    return manifest, GPT_USAGE, len(failed_gene_names)
+
+
+def collect_batches(client, batch_dir, make_family_summaries=True):
+    ''' Saves results of finished batch jobs which are not collected yet. Returns True if all jobs are finished. '''
+    batches = read_batch_state(batch_dir)
+    for batch_info in batches:
+        if batch_info['collected']:
+            continue
+        batch = client.batches.retrieve(batch_info['id'])
+        batch_info['status'] = batch.status
+        if batch.status not in TERMINAL_STATUSES:
+            continue
+
+        # expired and cancelled jobs can have partial results
+        responses = read_batch_output(client, batch.output_file_id)
+        print(f'INFO: Batch {batch.id} {batch.status}, {len(responses)} successful responses')
+        for request_file in batch_info['request_files']:
+            manifest, GPT_USAGE, num_failed = distribute_gene_summaries(batch_dir, request_file, responses)
+            stage_usages = {'genes_batch': GPT_USAGE}
+            # runs with failed genes are summarized when all their genes are collected
+            if make_family_summaries and num_failed == 0:
+                stage_usages['family'] = make_family_summary(client, manifest)
+            for stage, stage_usage in stage_usages.items():
+                verbose_gpu_usage(stage_usage, manifest['config'], stage=stage)
+            save_gpu_usage(f'{manifest["dir_name"]}/{manifest["query"]}/{manifest["run_name"]}/usage.json', stage_usages, manifest['config'], accumulate=True)
+        batch_info['collected'] = True
+        write_batch_state(batch_dir, batches)
+
+    write_batch_state(batch_dir, batches)
+    return all(x['collected'] for x in batches)
+
+
+def make_family_summary(client, manifest):
+    ''' Returns usage of the family summarization '''
+    query, dir_name, run_name, config = manifest['query'], manifest['dir_name'], manifest['run_name'], manifest['config']
+    # gene summaries are read from the saved file (and their citations are checked), no requests are made
+    _, gene_names, gpt4_responses = get_gpt_genes_response(client, query, dir_name, run_name, manifest['gpt4_n'], config)
+    if len(gene_names) == 0:
+        print(f'INFO: No gene summaries for {query}. Family summary is not possible')
+        return init_gpu_usage()
+    GPT_USAGE, parsed_response, pmid_parsed_response = get_gpt_family_response(client, query, dir_name, run_name, gene_names, gpt4_responses, config, manifest['text_output_dir_name'])
+    print('*'*30 + query + '*'*30, f'\n{parsed_response}\n', '*'*79)
+    return GPT_USAGE
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=["submit", "collect", "wait"])
+    parser.add_argument('-batch-dir', '--batch-dir', type=str, required=True)
+    parser.add_argument('-family', '--family-summaries', type=int, default=1, help='make family summaries after collecting gene summaries, default=1')
+    parser.add_argument('-prices', '--prices', type=str, default=None, help='JSON file with model prices, see main_gene_annot.py')
+    parser.add_argument('-pmid-cache', '--pmid-cache', type=str, default=None, help='JSONL file with PMCID -> PMID conversions, see main_gene_annot.py')
+    parser.add_argument('-poll', '--poll-interval', type=int, default=60, help='seconds between status checks for wait, default=60')
+    args = parser.parse_args()
+
+    if args.prices is not None:
+        load_model_prices(args.prices)
+    if args.pmid_cache is not None:
+        init_pmid_cache(args.pmid_cache)
+
+    client = openai.OpenAI()
+    if args.command == "submit":
+        submit_batches(client, args.batch_dir)
+    if args.command == "collect":
+        collect_batches(client, args.batch_dir, make_family_summaries=args.family_summaries)
+    if args.command == "wait":
+        while True:
+            finished = collect_batches(client, args.batch_dir, make_family_summaries=args.family_summaries)
+            if len(get_pending_request_files(args.batch_dir)) > 0:
+                # requests of the failed genes
+                submit_batches(client, args.batch_dir)
+            elif finished:
+                break
+            time.sleep(args.poll_interval)
+        print('INFO: All batches are finished')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+''' On-disk cache which can be shared between genes, families and runs.
+
+    Each entry is a zlib-compressed file named by the sha256 of its key,
+    e.g. full-text XML of a paper keyed by its PMCID.
+    Entries are written to a temporary file and renamed into place, so several
+    runs can use the same cache directory on a shared filesystem.
+    When the cache grows over its size cap, least recently used entries are removed
+    (an entry's modification time is updated every time it's read).
+'''
+
+import os
+import time
+import zlib
+import uuid
+import hashlib
+import threading
+
+
+class DiskCache:
+    # temporary files older than this (seconds) are left by runs which broke down while writing
+    stale_tmp_age = 3600
+
+    def __init__(self, cache_dir, max_size_mb=2048, evict_every=100):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        # checking the size of the cache requires listing it, so it's not done on every write
+        self.evict_every = evict_every
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+        self._lock = threading.Lock()
+        self._writes_since_eviction = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.evict()
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + '.z')
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def get(self, key):
+        ''' Returns cached bytes for the key or None '''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = zlib.decompress(f.read())
+        except (FileNotFoundError, zlib.error):
+            self._count('misses')
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another run in the meantime
+            pass
+        self._count('hits')
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        dir_path = os.path.dirname(path)
+        os.makedirs(dir_path, exist_ok=True)
+
+        tmp_path = os.path.join(dir_path, f'.{uuid.uuid4().hex}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(data))
+        os.replace(tmp_path, path)
+        self._count('writes')
+
+        with self._lock:
+            self._writes_since_eviction += 1
+            run_eviction = self._writes_since_eviction >= self.evict_every
+            if run_eviction:
+                self._writes_since_eviction = 0
+        if run_eviction:
+            self.evict()
+
+    def evict(self):
+        ''' Removes stale temporary files and least recently used entries until the cache is below 90% of the size cap '''
+        entries, total_size = [], 0
+        now = time.time()
+        for dir_path, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if file_name[0] == '.':
+                    # recent temporary files can be being written by another run
+                    if file_name.endswith('.tmp') and now - st.st_mtime > self.stale_tmp_age:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total_size += st.st_size
+
+        if total_size <= self.max_size:
+            return
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(path)
+                self._count('evictions')
+            except FileNotFoundError:
+                # removed by another run
+                pass
+            total_size -= size
+
+    def verbose_stats(self, name='cache'):
+        requests_total = self.stats['hits'] + self.stats['misses']
+        hit_rate = self.stats['hits'] / requests_total if requests_total > 0 else 0
+        print(f'INFO: {name}: {self.stats["hits"]} hits, {self.stats["misses"]} misses (hit rate {round(hit_rate, 2)}), {self.stats["writes"]} writes, {self.stats["evictions"]} evictions')
@@ -0,0 +1,96 @@
+''' Removal of near-duplicate snippets before they are joined into prompts.
+
+    Overlapping windows, preprints and reprints of the same paper produce snippets with almost the same text.
+    Snippets are compared by MinHash signatures of their word shingles, candidate pairs are found
+    with locality-sensitive hashing (LSH), so snippets are not compared all against all.
+    The first snippet of each group of near duplicates is kept. Dropped snippets stay in the snippet store,
+    so their IDs can still be traced, and duplicate_snippets.csv in the run directory records
+    which kept snippet each of them duplicates.
+'''
+
+import re
+import hashlib
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+
+from utils_snippet_store import read_gene_snippets
+
+
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def get_shingles(text, k=5):
+    words = re.findall(r'\w+', text.lower())
+    if len(words) <= k:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+
+def get_minhash_signatures(texts, num_perm=64, seed=24):
+    ''' Returns array (number of texts, num_perm) of MinHash signatures '''
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), 'little') % MERSENNE_PRIME
+                           for shingle in get_shingles(text)], dtype=np.uint64)
+        # values are below 2^31, so products fit into uint64
+        signatures[i] = ((np.outer(hashes, a) + b) % MERSENNE_PRIME).min(axis=0)
+    return signatures
+
+
+def find_near_duplicates(texts, threshold, num_perm=64, bands=16):
+    ''' Returns dictionary index of duplicate text -> (index of kept text, estimated Jaccard similarity).
+        Texts are processed in order, so the kept text is always the earlier one.
+    '''
+    signatures = get_minhash_signatures(texts, num_perm=num_perm)
+    rows = num_perm // bands
+
+    buckets = defaultdict(list)
+    duplicate_of = dict()
+    for i in range(len(texts)):
+        keys = [(band, signatures[i, band * rows:(band + 1) * rows].tobytes()) for band in range(bands)]
+        candidates = sorted(set(j for key in keys for j in buckets.get(key, [])))
+
+        if len(candidates) > 0:
+            similarities = (signatures[candidates] == signatures[i]).mean(axis=1)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= threshold:
+                duplicate_of[i] = (candidates[best], float(similarities[best]))
+                continue
+
+        # only kept texts are compared with the next ones
+        for key in keys:
+            buckets[key].append(i)
+    return duplicate_of
+
+
+def find_duplicate_snippets(query, dir_name, run_name, gene_names, threshold):
+    ''' Finds near-duplicate snippets of each gene. Returns set of snippet IDs which should not be used in prompts. '''
+    gene_names_, snippet_ids_, duplicate_of_, similarities_ = [], [], [], []
+    num_snippets = 0
+
+    for gene_name in gene_names:
+        df = read_gene_snippets(query, dir_name, gene_name)
+        snippet_ids = list(df['snippet_id'])
+        num_snippets += len(snippet_ids)
+
+        duplicate_of = find_near_duplicates([str(x) for x in df['snippet']], threshold)
+        for i, (j, similarity) in duplicate_of.items():
+            gene_names_.append(gene_name)
+            snippet_ids_.append(snippet_ids[i])
+            duplicate_of_.append(snippet_ids[j])
+            similarities_.append(round(similarity, 2))
+
+    df_duplicates = pd.DataFrame({'gene_name': gene_names_,
+                                  'snippet_id': snippet_ids_,
+                                  'duplicate_of': duplicate_of_,
+                                  'similarity': similarities_
+                                 })
+    df_duplicates.to_csv(f'{dir_name}/{query}/{run_name}/duplicate_snippets.csv')
+    print(f'INFO: {len(snippet_ids_)} of {num_snippets} snippets are near duplicates (similarity >= {threshold}), they will not be used in prompts')
+
+    return set(snippet_ids_)
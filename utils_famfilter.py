@@ -1,5 +1,32 @@
 import requests
 import os
+import io
+import json
+import urllib.parse
+import pandas as pd
+from requests.adapters import HTTPAdapter, Retry
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from utils_snippet_store import list_snippet_genes
+from utils_io import read_jsonl
+from utils_specindex import SpecIndex
+
+# offline specificity index (see utils_specindex.py), used instead of UniProt queries if loaded
+SPEC_INDEX = None
+
+
+def init_spec_index(index_dir):
+    global SPEC_INDEX
+    SPEC_INDEX = SpecIndex(index_dir)
+    print(f'INFO: Gene specificity is taken from the index {index_dir} ({SPEC_INDEX.meta["num_gene_names"]} gene names, built {SPEC_INDEX.meta["built_at"]})')
+
+
+def get_spec_source():
+    return 'index' if SPEC_INDEX is not None else 'uniprot'
+
 
 def get_cross_references(family, data):
     ''' Works with one page of the results '''
@@ -30,14 +57,65 @@ def get_cross_references(family, data):
     return all_hits, pos_hits, false_hits
 
 
-def get_hits_for_gene_name(family, gene_name, num_pages=20, verb=0):
+def get_cross_reference_counts(family, df):
+    ''' Same as get_cross_references for a table of entries with "PANTHER" column
+        (PANTHER IDs separated by ";", as in UniProt TSV results)
+    '''
+    all_hits = len(df)
+    if all_hits == 0:
+        return 0, 0, 0
+
+    panther_ids = df['PANTHER'].fillna('').astype(str).str.split(';').explode().str.strip()
+    # subfamilies are not counted
+    panther_ids = panther_ids[(panther_ids != '') & (~panther_ids.str.contains(':', regex=False))]
+
+    is_correct = (panther_ids == family).groupby(level=0).any()
+    pos_hits = int(is_correct.sum())
+    false_hits = int((~is_correct).sum())
+    return all_hits, pos_hits, false_hits
+
+
+def get_next_page_url(r):
+    if 'Link' in r.headers:
+        link_text = r.headers['Link']
+        link_text = link_text.split(';')[0]
+        return link_text[1:-1]
+    return None
+
+
+def get_hits_for_gene_name(family, gene_name, num_pages=20, verb=0, lean=True, max_entries=2000, sess=None):
+    ''' Counts UniProt entries of the gene: all, with PANTHER family, with other PANTHER families only.
+        lean=True requests only accessions and PANTHER cross-references (TSV, 500 entries per page), up to max_entries entries.
+        lean=False requests complete entries (JSON, 100 per page), up to num_pages pages.
+    '''
+    if sess is None:
+        sess = requests
+
     all_proteins = 0
     all_hits_total, pos_hits_total, false_hits_total  = 0, 0, 0
+
+    if lean:
+        query = f"https://rest.uniprot.org/uniprotkb/search?&query=gene:{gene_name}&fields=accession,xref_panther&format=tsv&size=500"
+        while query is not None and all_proteins < max_entries:
+            r = sess.get(query)
+            r.raise_for_status()
+            if len(r.text.strip()) == 0:
+                break
+            df = pd.read_csv(io.StringIO(r.text), sep='\t', dtype=str)
+            df = df.iloc[:max_entries - all_proteins]
+            all_proteins += len(df)
+
+            all_hits, pos_hits, false_hits = get_cross_reference_counts(family, df)
+            all_hits_total += all_hits
+            false_hits_total += false_hits
+            pos_hits_total += pos_hits
+            query = get_next_page_url(r)
+        return all_hits_total, pos_hits_total, false_hits_total
     
     query = f"https://rest.uniprot.org/uniprotkb/search?&query=gene:{gene_name}&size=100"
     
     for i in range(num_pages):        
-        r = requests.get(query)
+        r = sess.get(query)
         data = r.json()
         all_proteins += len(data['results'])
         
@@ -46,19 +124,77 @@ def get_hits_for_gene_name(family, gene_name, num_pages=20, verb=0):
         false_hits_total += false_hits
         pos_hits_total += pos_hits
         
-        if 'Link' in r.headers:
-            link_text = r.headers['Link']
-            link_text = link_text.split(';')[0]
-            query = link_text[1:-1]
-        else:
+        query = get_next_page_url(r)
+        if query is None:
             break
 
     return all_hits_total, pos_hits_total, false_hits_total
 
 
-def get_stats_for_gene_name(family, gene_name, verb_errors=False):
+def get_hits_for_gene_names(family, gene_names, max_entries=2000, num_pages=None, sess=None):
+    ''' Same counts as get_hits_for_gene_name(lean=True) for several genes with one query ("gene:A OR gene:B ...").
+        Gene names of the entries are requested too, results are split by gene locally: an entry counts for every
+        queried gene among its gene names (case-insensitive). Up to max_entries entries per gene are counted.
+        Pages are requested until every gene has max_entries entries or the results run out, but not more than
+        num_pages pages (default: as many as max_entries entries of every gene would take).
+        Returns dictionary gene_name -> (all, pos, false) and set of the genes whose counts are complete:
+        counts of the other genes were cut by num_pages.
+    '''
+    if sess is None:
+        sess = requests
+    if num_pages is None:
+        num_pages = -(-max_entries * len(gene_names) // 500)
+
+    gene_query = urllib.parse.quote(' OR '.join(f'gene:{gene_name}' for gene_name in gene_names))
+    query = f"https://rest.uniprot.org/uniprotkb/search?&query={gene_query}&fields=accession,gene_names,xref_panther&format=tsv&size=500"
+
+    dfs = [pd.DataFrame(columns=['Entry', 'Gene Names', 'PANTHER', 'gene_name'], dtype=str)]
+    num_entries = {gene_name.lower(): 0 for gene_name in gene_names}
+    for i in range(num_pages):
+        r = sess.get(query)
+        r.raise_for_status()
+        query = get_next_page_url(r)
+        if len(r.text.strip()) == 0:
+            query = None
+            break
+        df = pd.read_csv(io.StringIO(r.text), sep='\t', dtype=str)
+        # one row per (entry, gene name of the entry)
+        df['gene_name'] = df['Gene Names'].fillna('').str.lower().str.split().map(lambda x: list(dict.fromkeys(x)))
+        df = df.explode('gene_name')
+        df = df[df['gene_name'].isin(num_entries)]
+        dfs.append(df)
+        for gene_name, count in df['gene_name'].value_counts().items():
+            num_entries[gene_name] += count
+
+        if query is None or min(num_entries.values()) >= max_entries:
+            break
+
+    df = pd.concat(dfs, ignore_index=True)
+    hits, complete = dict(), set()
+    for gene_name in gene_names:
+        df_gene = df[df['gene_name'] == gene_name.lower()].iloc[:max_entries].reset_index(drop=True)
+        hits[gene_name] = get_cross_reference_counts(family, df_gene)
+        if query is None or num_entries[gene_name.lower()] >= max_entries:
+            complete.add(gene_name)
+    return hits, complete
+
+
+def get_uniprot_session(num_workers=4):
+    ''' Session with connection pool for num_workers concurrent requests and retries of failed requests '''
+    retries = Retry(total=5,
+                    backoff_factor=0.1,
+                    status_forcelist=[408, 429, 500, 501, 502, 503, 504])
+    sess = requests.Session()
+    sess.mount('https://', HTTPAdapter(max_retries=retries, pool_maxsize=max(num_workers, 10)))
+    return sess
+
+
+def get_stats_for_gene_name(family, gene_name, verb_errors=False, sess=None):
     try:
-        all_hits_total, pos_hits_total, false_hits_total  = get_hits_for_gene_name(family, gene_name)
+        if SPEC_INDEX is not None:
+            all_hits_total, pos_hits_total, false_hits_total = SPEC_INDEX.get_hits(family, gene_name)
+        else:
+            all_hits_total, pos_hits_total, false_hits_total  = get_hits_for_gene_name(family, gene_name, sess=sess)
     except:
         if verb_errors:
             print(f'INFO: Error in retrieving data for gene name {gene_name}')
@@ -75,31 +211,179 @@ def get_stats_for_gene_name(family, gene_name, verb_errors=False):
     return all_hits_total, prop_true, prop_false
 
 
-def make_spec_stats_file(dir_name, family):
-    # from scratch
-    
-    summary_path = f'{dir_name}/{family}/tmp/gene_spec_stats.tsv'
-    print('INFO: Creating gene specificity file', summary_path)
-    
-    summ_file = open(summary_path, 'w')
+def get_spec_store_path(dir_name, family):
+    return f'{dir_name}/{family}/tmp/gene_spec_store.jsonl'
 
-    gene_names = os.listdir(f'{dir_name}/{family}/snippets_per_gene')
-    gene_names = [x[:-4] for x in gene_names]
-    print(f'INFO: Found {len(gene_names)} gene names')
-    
+
+def read_spec_store(dir_name, family):
+    ''' Returns dictionary gene_name -> record of its specificity statistics:
+        {"family", "gene_name", "status": "ok"/"no_hits", "all_hits_total", "prop_true", "prop_false", "source": "uniprot"/"index", "computed_at"}.
+        Later records of a gene replace earlier ones.
+    '''
+    store = dict()
+    for record in read_jsonl(get_spec_store_path(dir_name, family)):
+        if record.get('family') == family:
+            store[record['gene_name']] = record
+    return store
+
+
+def append_spec_store(dir_name, family, record):
+    with open(get_spec_store_path(dir_name, family), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+
+
+def compact_spec_store(dir_name, family, store):
+    ''' Rewrites the store with one record per gene '''
+    path = get_spec_store_path(dir_name, family)
+    with open(path + '.tmp', 'w') as f:
+        for gene_name in sorted(store):
+            f.write(json.dumps(store[gene_name]) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def is_spec_record_fresh(record, ttl_days):
+    ''' ttl_days=None: records never expire. Records computed from another source (UniProt queries or the index) are not used. '''
+    if record.get('source', 'uniprot') != get_spec_source():
+        return False
+    if ttl_days is None:
+        return True
+    computed_at = datetime.fromisoformat(record['computed_at'])
+    return datetime.now() - computed_at < timedelta(days=ttl_days)
+
+
+def make_spec_record(family, gene_name, stats):
+    ''' stats: (all_hits_total, prop_true, prop_false) or None if UniProt has no entries of the gene '''
+    record = {'family': family, 'gene_name': gene_name}
+    if stats is None:
+        record['status'] = 'no_hits'
+    else:
+        all_hits_total, prop_true, prop_false = stats
+        record.update({'status': 'ok', 'all_hits_total': all_hits_total, 'prop_true': prop_true, 'prop_false': prop_false})
+    record['source'] = get_spec_source()
+    record['computed_at'] = datetime.now().isoformat(timespec='seconds')
+    return record
+
+
+def compute_spec_record(family, gene_name, sess=None):
+    ''' Returns record for the specificity store or None if UniProt requests failed '''
+    try:
+        stats = get_stats_for_gene_name(family, gene_name, sess=sess)
+    except ZeroDivisionError:
+        stats = None
+    except:
+        print('INFO: Error in retrieving data for gene name', gene_name)
+        return None
+    return make_spec_record(family, gene_name, stats)
+
+
+def compute_spec_records(family, gene_names, sess=None):
+    ''' Returns dictionary gene_name -> record (None if UniProt requests failed), genes are queried in one batch.
+        If the batch query fails, genes are queried one by one, genes with cut or zero counts in the batch are queried on their own.
+        The index is always used gene by gene.
+    '''
+    if len(gene_names) == 1 or SPEC_INDEX is not None:
+        return {gene_name: compute_spec_record(family, gene_name, sess=sess) for gene_name in gene_names}
+
+    try:
+        hits, complete = get_hits_for_gene_names(family, gene_names, sess=sess)
+    except:
+        print(f'INFO: Error in retrieving data for {len(gene_names)} gene names in one query, querying them one by one')
+        return {gene_name: compute_spec_record(family, gene_name, sess=sess) for gene_name in gene_names}
+
+    records = dict()
     for gene_name in gene_names:
-        try:
-            all_hits_total, prop_true, prop_false = get_stats_for_gene_name(family, gene_name)
-        except:
-            print('INFO: Error in retrieving data for gene name', gene_name)
-            continue
-            
-        if all_hits_total == 0:
-            print('INFO:', family, 'Division by zero attempted')
+        all_hits_total, pos_hits_total, false_hits_total = hits[gene_name]
+        if gene_name not in complete or all_hits_total == 0:
+            # batch counts are not reliable for the gene: no_hits is saved only from its own query
+            records[gene_name] = compute_spec_record(family, gene_name, sess=sess)
             continue
+        stats = (all_hits_total, pos_hits_total/all_hits_total, false_hits_total/all_hits_total)
+        records[gene_name] = make_spec_record(family, gene_name, stats)
+    return records
+
+
+def write_spec_stats_file(dir_name, family, gene_names, store):
+    summary_path = f'{dir_name}/{family}/tmp/gene_spec_stats.tsv'
+    with open(summary_path, 'w') as summ_file:
+        for gene_name in gene_names:
+            if gene_name not in store or store[gene_name]['status'] != 'ok':
+                continue
+            record = store[gene_name]
+            print(f'{gene_name}\t{record["all_hits_total"]}\t{round(record["prop_true"], 2)}\t{round(record["prop_false"], 2)}', file=summ_file)
+    print('INFO: Created gene specificity file', summary_path)
+
+
+def make_spec_stats_file(dir_name, family, ttl_days=30, num_workers=4, batch_size=1):
+    ''' Makes gene_spec_stats.tsv for all genes with snippets (see iter_spec_stats). '''
+    gene_names = list_snippet_genes(family, dir_name)
+    print(f'INFO: Found {len(gene_names)} gene names')
+    for gene_name, record in iter_spec_stats(dir_name, family, gene_names, ttl_days=ttl_days, num_workers=num_workers, batch_size=batch_size):
+        if record is not None and record['status'] == 'no_hits':
+            print('INFO:', family, gene_name, 'has no UniProt entries')
+
+
+def iter_spec_stats(dir_name, family, gene_names, ttl_days=30, num_workers=4, batch_size=1):
+    ''' Yields (gene_name, record) in the order of gene_names; record is None if UniProt requests failed.
+        Records are taken from the specificity store or computed. Genes are queried in batches of batch_size genes
+        (one UniProt query per batch, see get_hits_for_gene_names), up to num_workers batches ahead are computed concurrently
+        on one pooled session.
+        The consumer can stop early: genes after it are not queried (except the ones already being computed).
+        At the end, the store is compacted and gene_spec_stats.tsv is made for the genes which have records.
+    '''
+    store = read_spec_store(dir_name, family)
+    num_computed = 0
+    num_workers, batch_size = max(num_workers, 1), max(batch_size, 1)
+    sess = get_uniprot_session(num_workers)
+
+    def get_records(batch):
+        ''' Returns dictionary gene_name -> (record, computed) '''
+        records = {gene_name: (store[gene_name], False) for gene_name in batch
+                   if gene_name in store and is_spec_record_fresh(store[gene_name], ttl_days)}
+        genes_to_compute = [gene_name for gene_name in batch if gene_name not in records]
+        if len(genes_to_compute) > 0:
+            computed = compute_spec_records(family, genes_to_compute, sess=sess)
+            records.update({gene_name: (computed[gene_name], True) for gene_name in genes_to_compute})
+        return records
+
+    def save(gene_name, record):
+        # called from the consumer thread only
+        append_spec_store(dir_name, family, record)
+        store[gene_name] = record
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    remaining = iter(gene_names)
+    batches = iter(lambda: list(islice(remaining, batch_size)), [])
+    futures = deque((batch, executor.submit(get_records, batch)) for batch in islice(batches, num_workers))
+    try:
+        while len(futures) > 0:
+            batch, future = futures.popleft()
+            next_batch = next(batches, None)
+            if next_batch is not None:
+                futures.append((next_batch, executor.submit(get_records, next_batch)))
 
-        # sort first?
-        print(f'{gene_name}\t{all_hits_total}\t{round(prop_true, 2)}\t{round(prop_false, 2)}', file=summ_file)
-        print(f'{gene_name}\t{all_hits_total}\t{round(prop_true, 2)}\t{round(prop_false, 2)}')
+            records = future.result()
+            for gene_name in batch:
+                record, computed = records[gene_name]
+                if computed and record is not None:
+                    save(gene_name, record)
+                    num_computed += 1
+                    # the whole batch is saved before its first gene is yielded
+                    records[gene_name] = (record, False)
+            for gene_name in batch:
+                yield gene_name, records[gene_name][0]
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        sess.close()
+        # genes computed ahead are saved too
+        for batch, future in futures:
+            if future.done() and not future.cancelled():
+                for gene_name, (record, computed) in future.result().items():
+                    if computed and record is not None:
+                        save(gene_name, record)
+                        num_computed += 1
 
-    summ_file.close()
+        print(f'INFO: {num_computed} genes were queried in UniProt for specificity')
+        if num_computed > 0:
+            compact_spec_store(dir_name, family, store)
+        write_spec_stats_file(dir_name, family, list_snippet_genes(family, dir_name), store)
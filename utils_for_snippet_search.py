@@ -1,8 +1,8 @@
 import os
-import json
 import pandas as pd
 import pickle
-from utils import mkdirsafe
+from utils import mkdirsafe, read_snippet_search_log
+from utils_snippet_store import list_snippet_genes, uses_sqlite_store
 
 
 def get_num_genes(dir_name, acc):
@@ -19,21 +19,18 @@ def get_num_genes(dir_name, acc):
     
 
 def get_num_genes_with_snippets(dir_name, acc):
-    path = f'{dir_name}/{acc}/snippets_per_gene'
-    if not os.path.exists(path):
+    if not os.path.exists(f'{dir_name}/{acc}/snippets_per_gene') and not uses_sqlite_store(acc, dir_name):
         print('INFO: snippets dir does not exist')
         return 0
-    l = len(os.listdir(path))
+    l = len(list_snippet_genes(acc, dir_name))
     return l
 
 
 def get_log_stats(dir_name, acc):
-    log_file = f'{dir_name}/{acc}/gene_snippet_search_log.json'
-    with open(log_file, 'r') as f:
-        log_data = json.load(f)
-        num_processed = len(log_data)
-        num_success = list(log_data.values()).count('success')
-        num_fail = list(log_data.values()).count('fail')
+    log_data = read_snippet_search_log(acc, dir_name)
+    num_processed = len(log_data)
+    num_success = list(log_data.values()).count('success')
+    num_fail = list(log_data.values()).count('fail')
     return num_processed, num_success, num_fail
 
 
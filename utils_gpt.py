@@ -4,41 +4,194 @@ import os
 import random
 import pandas as pd
 import re
+import time
+import threading
 import requests
 from datetime import datetime
 import requests
 from xml.etree import ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 
 from utils import mkdirsafe
 from utils import get_gene_summary_citations, get_family_summary_citations
 from utils import find_citations
 
 from utils import get_selected_genes_filepaths
+from utils import get_prompt_layout, GENE_PLACEHOLDER, NUM_GENES_PLACEHOLDER
+from utils_cache import DiskCache
+from utils_io import read_jsonl
+from utils_snippet_store import read_paper_metadata
 
 # needed for specificity filtering
 # from utils_famfilter import get_cross_references, get_stats_for_gene_name
 
-model_cost = {'gpt-4o-2024-05-13': 5,
-              'gpt-4-turbo-2024-04-09': 10
-             }
+# USD per 1M tokens; can be extended with load_model_prices or replaced by "price" in the config
+model_prices = {'gpt-4o-2024-05-13': {'input': 5, 'output': 15},
+                'gpt-4o-2024-08-06': {'input': 2.5, 'cached_input': 1.25, 'output': 10},
+                'gpt-4o-mini-2024-07-18': {'input': 0.15, 'cached_input': 0.075, 'output': 0.6},
+                'gpt-4-turbo-2024-04-09': {'input': 10, 'output': 30},
+                'o3-mini-2025-01-31': {'input': 1.1, 'cached_input': 0.55, 'output': 4.4}
+               }
 
+# batch jobs cost half the price
+BATCH_PRICE_FACTOR = 0.5
 
-def init_gpu_usage():
-    return dict({'NUM_CALLS': 0, 'NUM_CHARS': 0})
 
+def load_model_prices(path):
+    ''' Adds prices from JSON file: {"model": {"input": ..., "cached_input": ..., "output": ...}} '''
+    with open(path, 'r') as f:
+        model_prices.update(json.load(f))
 
-def verbose_gpu_usage(GPT_USAGE, config):
-    cost_per_1M = model_cost[config['model']]
-    print('GPT-4 usage:')
-    # 4 chars ≈ 1 token
-    print(f'{GPT_USAGE["NUM_CALLS"]} calls, {GPT_USAGE["NUM_CHARS"]} tokens processed (tokens ≈ characters / 4). Approximate cost: ${round(GPT_USAGE["NUM_CHARS"] / 4 / 1000000 * cost_per_1M, 2)}')
 
+def get_model_price(config):
+    if 'price' in config:
+        return config['price']
+    return model_prices.get(config['model'])
 
-def create_summary(client, messages, model):
+
+# cache of chat completions shared by all stages, see init_response_cache
+RESPONSE_CACHE = None
+RESPONSE_CACHE_BYPASS = False
+
+
+def init_response_cache(cache_dir, max_size_mb=512, bypass=False):
+    ''' Responses are cached by hash of (model, messages, parameters). With bypass, cached responses are not used,
+        but new responses are still saved.
+    '''
+    global RESPONSE_CACHE, RESPONSE_CACHE_BYPASS
+    RESPONSE_CACHE = DiskCache(cache_dir, max_size_mb=max_size_mb)
+    RESPONSE_CACHE_BYPASS = bypass
+
+
+def init_gpu_usage(price_factor=1):
+    return dict({'NUM_CALLS': 0, 'NUM_CHARS': 0, 'NUM_CACHED_CALLS': 0,
+                 'PROMPT_TOKENS': 0, 'CACHED_TOKENS': 0, 'COMPLETION_TOKENS': 0,
+                 'LATENCY': 0, 'WALL_TIME': 0, 'PRICE_FACTOR': price_factor})
+
+
+def get_call_usage(response):
+    ''' Returns token usage and latency of one call from its response '''
+    usage = response.get('usage') or {}
+    prompt_tokens_details = usage.get('prompt_tokens_details') or {}
+    return {'prompt_tokens': usage.get('prompt_tokens') or 0,
+            'cached_tokens': prompt_tokens_details.get('cached_tokens') or 0,
+            'completion_tokens': usage.get('completion_tokens') or 0,
+            'latency': response.get('latency'),
+            'cache_hit': bool(response.get('cache_hit'))}
+
+
+def add_gpu_usage(GPT_USAGE, call_usage, num_chars):
+    # responses from the response cache cost nothing
+    if call_usage['cache_hit']:
+        GPT_USAGE['NUM_CACHED_CALLS'] += 1
+        return
+    GPT_USAGE['NUM_CALLS'] += 1
+    GPT_USAGE['NUM_CHARS'] += num_chars
+    GPT_USAGE['PROMPT_TOKENS'] += call_usage['prompt_tokens']
+    GPT_USAGE['CACHED_TOKENS'] += call_usage['cached_tokens']
+    GPT_USAGE['COMPLETION_TOKENS'] += call_usage['completion_tokens']
+    if call_usage['latency'] is not None:
+        GPT_USAGE['LATENCY'] = round(GPT_USAGE['LATENCY'] + call_usage['latency'], 3)
+
+
+def get_gpu_cost(GPT_USAGE, config):
+    ''' Returns cost in USD or None if the price of the model is unknown '''
+    price = get_model_price(config)
+    if price is None:
+        return None
+    uncached_tokens = GPT_USAGE['PROMPT_TOKENS'] - GPT_USAGE['CACHED_TOKENS']
+    cost = (uncached_tokens * price['input']
+            + GPT_USAGE['CACHED_TOKENS'] * price.get('cached_input', price['input'])
+            + GPT_USAGE['COMPLETION_TOKENS'] * price['output']) / 1000000
+    return cost * GPT_USAGE['PRICE_FACTOR']
+
+
+def verbose_gpu_usage(GPT_USAGE, config, stage=''):
+    print(f'GPT-4 usage {stage}:')
+    mean_latency = GPT_USAGE['LATENCY'] / GPT_USAGE['NUM_CALLS'] if GPT_USAGE['NUM_CALLS'] > 0 else 0
+    print(f'{GPT_USAGE["NUM_CALLS"]} calls, {GPT_USAGE["PROMPT_TOKENS"]} prompt tokens ({GPT_USAGE["CACHED_TOKENS"]} cached), {GPT_USAGE["COMPLETION_TOKENS"]} completion tokens, mean latency {round(mean_latency, 2)} s')
+    cost = get_gpu_cost(GPT_USAGE, config)
+    if cost is not None:
+        print(f'Cost: ${round(cost, 4)}')
+    else:
+        print(f'No price for model {config["model"]}, add it with "price" in the config')
+    if RESPONSE_CACHE is not None:
+        print(f'{GPT_USAGE["NUM_CACHED_CALLS"]} calls answered from the response cache')
+        RESPONSE_CACHE.verbose_stats('LLM response cache')
+
+
+def read_gpu_usage(path):
+    ''' Returns dictionary stage -> usage saved by save_gpu_usage (empty if the file doesn't exist) '''
+    if not os.path.exists(path):
+        return dict()
+    with open(path, 'r') as f:
+        stages = json.load(f)['stages']
+    stage_usages = dict()
+    for stage, saved_usage in stages.items():
+        stage_usages[stage] = init_gpu_usage()
+        stage_usages[stage].update({key.upper(): value for key, value in saved_usage.items() if key != 'cost'})
+    return stage_usages
+
+
+def save_gpu_usage(path, stage_usages, config, accumulate=False):
+    ''' Saves usage and cost of each stage and their totals to JSON file.
+        accumulate=True: usage is added to the usage of the same stages saved in the file before
+        (e.g. by earlier runs or batch attempts), other saved stages are kept.
+    '''
+    if accumulate:
+        saved_usages = read_gpu_usage(path)
+        for stage, GPT_USAGE in stage_usages.items():
+            if stage in saved_usages:
+                saved_usage = saved_usages[stage]
+                for key in GPT_USAGE:
+                    if key != 'PRICE_FACTOR':
+                        saved_usage[key] = round(saved_usage[key] + GPT_USAGE[key], 3)
+            else:
+                saved_usages[stage] = GPT_USAGE
+        stage_usages = saved_usages
+
+    stages, total = dict(), init_gpu_usage()
+    total_cost = 0
+    for stage, GPT_USAGE in stage_usages.items():
+        cost = get_gpu_cost(GPT_USAGE, config)
+        stages[stage] = {key.lower(): value for key, value in GPT_USAGE.items()}
+        stages[stage]['cost'] = cost
+        for key in total:
+            if key != 'PRICE_FACTOR':
+                total[key] += GPT_USAGE[key]
+        total_cost = None if (cost is None or total_cost is None) else total_cost + cost
+    del total['PRICE_FACTOR']
+    total = {key.lower(): value for key, value in total.items()}
+    total['cost'] = total_cost
+
+    with open(path, 'w') as f:
+        json.dump({'model': config['model'], 'price': get_model_price(config), 'stages': stages, 'total': total}, f, indent=1)
+
+
+def get_response_cache_key(messages, model, params):
+    return json.dumps({'model': model, 'messages': messages, 'params': params}, sort_keys=True)
+
+
+def create_summary(client, messages, model, **params):
+    ''' Returns response dictionary with "latency" of the call in seconds.
+        Responses taken from the response cache have "cache_hit": True.
+    '''
+    if RESPONSE_CACHE is not None:
+        cache_key = get_response_cache_key(messages, model, params)
+        if not RESPONSE_CACHE_BYPASS:
+            data = RESPONSE_CACHE.get(cache_key)
+            if data is not None:
+                response = json.loads(data)
+                response['cache_hit'] = True
+                response['latency'] = None
+                return response
+
+    start = time.perf_counter()
     try:
         completion = client.chat.completions.create(
             messages=messages,
             model=model,
+            **params
         )
     except openai.NotFoundError:
         raise
@@ -47,7 +200,14 @@ def create_summary(client, messages, model):
     except openai.OpenAIError:
         raise
     else:
-        return completion.model_dump(exclude_unset=True)
+        response = completion.model_dump(exclude_unset=True)
+        latency = round(time.perf_counter() - start, 3)
+
+    # unfinished responses are not cached, so they are requested again next time
+    if RESPONSE_CACHE is not None and all(choice.get('finish_reason') == 'stop' for choice in response.get('choices', [])):
+        RESPONSE_CACHE.put(cache_key, json.dumps(response).encode())
+    response['latency'] = latency
+    return response
 
 
 def parse_response(response):
@@ -60,55 +220,183 @@ def parse_response(response):
         return 'No response'
 
 
-def get_gpt_genes_response(client, query, dir_name, run_name, gpt4_n, config):
+# used when config has no "instr_reduce_gene_temp"
+REDUCE_GENE_TEMP = ("You will be provided with {1} summaries of gene {0} function, each of them made from a different list of texts. "
+                    "Your task is to merge them into one summary of {0} function. Try to make a good generalization of the information, without providing too many details. "
+                    "If you use a statement from a summary that is followed by a citation in square brackets, you must use the same citation in your response. "
+                    "You can only cite the identifiers that were present in the summaries, example: [PMC10000000_0], [PMC12345678_9]. "
+                    "Do not put anything else in square brackets. Ignore summaries which say that the summary cannot be created. "
+                    "If all of them say so, respond that the summary cannot be created. Your answer shouldn't be longer than 200 words.")
+
+
+def make_gene_reduce_prompt(gene_name, chunk_responses, config):
+    reduce_temp = config.get('instr_reduce_gene_temp', REDUCE_GENE_TEMP)
+    if get_prompt_layout(config) == 'prefix':
+        prompt_text = reduce_temp.format(GENE_PLACEHOLDER, len(chunk_responses)) + '\n' + '\n' + f'Target gene: {gene_name}\n'
+    else:
+        prompt_text = reduce_temp.format(gene_name, len(chunk_responses)) + '\n' + '\n'
+    for i, chunk_response in enumerate(chunk_responses):
+        prompt_text += f'Summary {i + 1}:\n'
+        prompt_text += chunk_response
+        prompt_text += '\n'
+    return prompt_text
+
+
+def make_gene_messages(prompt, config):
+    messages=[
+        {"role": "system", "content": config['system']},
+        {"role": "user", "content": prompt}
+    ]
+    return messages
+
+
+def get_gene_summary(client, gene_name, prompts, config, call_slots=None, call_log=None):
+    ''' Summarizes gene from its prompts. If there are several prompts (map-reduce mode), each of them is summarized
+        in parallel and the summaries are merged into one.
+        call_slots: semaphore shared by the genes which are summarized in parallel, it bounds the number of calls in flight
+        call_log: list for the log of the calls (one dictionary per call), it keeps the calls made before an exception
+        Returns summary, summaries of the prompts and log of the calls.
+    '''
+    model = config['model']
+    if call_log is None:
+        call_log = []
+    if call_slots is None:
+        call_slots = threading.BoundedSemaphore(len(prompts))
+
+    def summarize(prompt, call_name):
+        messages = make_gene_messages(prompt, config)
+        record = {'gene_name': gene_name, 'call': call_name, 'num_chars': len(prompt)}
+        try:
+            with call_slots:
+                response = create_summary(client, messages, model)
+        except Exception as e:
+            record['error'] = repr(e)
+            call_log.append(record)
+            raise
+        record.update(get_call_usage(response))
+        record['error'] = None
+        call_log.append(record)
+        return parse_response(response)
+
+    if len(prompts) == 1:
+        return summarize(prompts[0], 'prompt_0'), [], call_log
+
+    with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+        chunk_responses = list(executor.map(summarize, prompts, [f'prompt_{i}' for i in range(len(prompts))]))
+
+    reduce_prompt = make_gene_reduce_prompt(gene_name, chunk_responses, config)
+    return summarize(reduce_prompt, 'reduce'), chunk_responses, call_log
+
+
+def get_gpt_genes_response(client, query, dir_name, run_name, gpt4_n, config, max_chunks=1, num_workers=1):
+    ''' max_chunks: number of prompts per gene which are summarized and merged (map-reduce),
+        default=1 (only the first prompt of each gene is used)
+        num_workers: number of genes summarized in parallel, also the maximum number of API calls in flight
+    '''
     print('INFO: running per-gene summarization')
     model = config['model']
     GPT_USAGE = init_gpu_usage()
     
     prefix = f'{dir_name}/{query}/{run_name}/per_gene_joined_prompts_dirty'
     response_df_path = f'{dir_name}/{query}/{run_name}/per_gene_summaries_{model}_sample_{gpt4_n}_4o.csv'
+    chunk_df_path = f'{dir_name}/{query}/{run_name}/per_gene_chunk_summaries_{model}_sample_{gpt4_n}.csv'
+    calls_df_path = f'{dir_name}/{query}/{run_name}/per_gene_calls_{model}_sample_{gpt4_n}.csv'
+
+    # SHOULD I MOVE IT?
+    gene_prompt_paths = get_selected_genes_filepaths(query, dir_name, run_name, gpt4_n)
 
     # maybe i can make another version of the response instead
+    # the file has only the genes which were summarized, failed genes are requested again on the next run
+    df_existing = pd.DataFrame(columns=['gene_name', 'response'])
     if os.path.exists(response_df_path):
-        print(f'INFO: Gene summaries exist for this sample size ({gpt4_n}) and model ({model})! No rerunning GPT-4 will happen.')
-        df = pd.read_csv(response_df_path)
-        get_gene_summary_citations(query, dir_name, response_df_path)
-        return GPT_USAGE, list(df['gene_name']), list(df['response'])
+        df_existing = pd.read_csv(response_df_path, index_col=0)
+        existing_gene_names = set(df_existing['gene_name'])
+        missing_paths = [x for x in gene_prompt_paths if os.path.splitext(x)[0] not in existing_gene_names]
+        if len(missing_paths) == 0:
+            print(f'INFO: Gene summaries exist for this sample size ({gpt4_n}) and model ({model})! No rerunning GPT-4 will happen.')
+            get_gene_summary_citations(query, dir_name, response_df_path)
+            return GPT_USAGE, list(df_existing['gene_name']), list(df_existing['response'])
+        print(f'INFO: Gene summaries exist for {len(gene_prompt_paths) - len(missing_paths)} of {len(gene_prompt_paths)} genes, only the missing genes are summarized')
+        gene_prompt_paths = missing_paths
 
-    # SHOULD I MOVE IT?
-    gene_prompt_paths = get_selected_genes_filepaths(query, dir_name, run_name, gpt4_n)
     gene_names, gpt4_responses = [], []
+    chunk_gene_names, chunk_nums, chunk_responses_ = [], [], []
+    call_log, failed_gene_names = [], []
+    # API calls in flight (including map-reduce calls of the genes) are bounded by num_workers
+    call_slots = threading.BoundedSemaphore(max(num_workers, 1))
+
+    def process_gene(query_path):
+        df = pd.read_csv(prefix + '/' + query_path)
+        prompts = list(df['prompt'])[:max(max_chunks, 1)]
+        num_snippets = int(df['num_snippets'][:len(prompts)].sum())
+        print(query_path, 'number of prompts:', len(prompts), 'of', len(df), 'length of prompts:', sum(len(x) for x in prompts), 'chars, num snippets:', num_snippets)
+
+        gene_name = os.path.splitext(query_path)[0]
+        gene_call_log = []
+        try:
+            return (gene_name,) + get_gene_summary(client, gene_name, prompts, config, call_slots=call_slots, call_log=gene_call_log)
+        except Exception as e:
+            # one failed gene doesn't stop the others; its calls (including the paid ones before the error) are in the calls log
+            print(f'WARNING: summarization of gene {gene_name} failed: {repr(e)}')
+            if all(record.get('error') is None for record in gene_call_log):
+                gene_call_log.append({'gene_name': gene_name, 'call': 'gene', 'error': repr(e)})
+            return gene_name, None, [], gene_call_log
     
     if len(gene_prompt_paths) == 0:
         print('No genes found!')
     else:
-        for query_path in gene_prompt_paths:
-            df = pd.read_csv(prefix + '/' + query_path)
-            prompt = list(df['prompt'])[0]
-            num_snippets = int(list(df['num_snippets'])[0])
-            print(query_path, 'length of prompt:', len(prompt), 'chars, num snippets:', num_snippets)
-    
-            messages=[
-                {"role": "system", "content": config['system']},
-                {"role": "user", "content": prompt}
-            ]
+        print(f'INFO: Running GPT4 API for gene summarization ({len(gene_prompt_paths)} genes, {num_workers} in parallel)')
+        start = time.perf_counter()
+        # results are in the order of selected genes
+        with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+            results = list(executor.map(process_gene, gene_prompt_paths))
+
+        for gene_name, parsed_response, chunk_responses, gene_call_log in results:
+            call_log.extend(gene_call_log)
+            if parsed_response is None:
+                failed_gene_names.append(gene_name)
+                continue
 
-            print('INFO: Running GPT4 API for gene summarization')
-    
-            response = create_summary(client, messages, model)
-            GPT_USAGE['NUM_CALLS'] += 1
-            GPT_USAGE['NUM_CHARS'] += len(prompt)
-            parsed_response = parse_response(response)
-
-            gene_name = os.path.splitext(query_path)[0]
             gene_names.append(gene_name)
-            
             gpt4_responses.append(parsed_response)
-    
+
+            for i, chunk_response in enumerate(chunk_responses):
+                chunk_gene_names.append(gene_name)
+                chunk_nums.append(i)
+                chunk_responses_.append(chunk_response)
+
+        for record in call_log:
+            if record.get('error') is None:
+                add_gpu_usage(GPT_USAGE, record, record['num_chars'])
+        GPT_USAGE['WALL_TIME'] = round(time.perf_counter() - start, 3)
+        df_calls = pd.DataFrame(call_log, columns=['gene_name', 'call', 'num_chars', 'latency', 'prompt_tokens', 'cached_tokens', 'completion_tokens', 'cache_hit', 'error'])
+        if len(df_existing) > 0 and os.path.exists(calls_df_path):
+            # calls of the earlier runs are kept
+            df_calls = pd.concat([pd.read_csv(calls_df_path, index_col=0), df_calls], ignore_index=True)
+        df_calls.to_csv(calls_df_path)
+        print(f'INFO: {len(gene_names)} genes summarized in {round(GPT_USAGE["WALL_TIME"], 1)} s, {GPT_USAGE["PROMPT_TOKENS"]} prompt tokens ({GPT_USAGE["CACHED_TOKENS"]} cached, per call in {os.path.basename(calls_df_path)})')
+        if len(failed_gene_names) > 0:
+            print(f'WARNING: {len(failed_gene_names)} genes failed and are not used in the family summary, they will be requested again on the next run:', ', '.join(failed_gene_names))
+
+        # genes summarized earlier and now, in the order of selected genes
+        summaries = dict(zip(df_existing['gene_name'], df_existing['response']))
+        summaries.update(zip(gene_names, gpt4_responses))
+        selected_gene_names = [os.path.splitext(x)[0] for x in get_selected_genes_filepaths(query, dir_name, run_name, gpt4_n)]
+        gene_names = [x for x in selected_gene_names if x in summaries]
+        gpt4_responses = [summaries[x] for x in gene_names]
+
         df = pd.DataFrame({'gene_name': gene_names,
                            'response': gpt4_responses})
         
         df.to_csv(response_df_path)
+
+        if len(chunk_responses_) > 0:
+            df_chunks = pd.DataFrame({'gene_name': chunk_gene_names,
+                                      'chunk': chunk_nums,
+                                      'response': chunk_responses_})
+            if len(df_existing) > 0 and os.path.exists(chunk_df_path):
+                df_chunks = pd.concat([pd.read_csv(chunk_df_path, index_col=0), df_chunks], ignore_index=True)
+            df_chunks.to_csv(chunk_df_path)
         
     get_gene_summary_citations(query, dir_name, response_df_path)
     
@@ -116,8 +404,20 @@ def get_gpt_genes_response(client, query, dir_name, run_name, gpt4_n, config):
     
 
 def make_family_prompt(gene_names, gpt4_responses, config):
+    if config['instr_2_fam_temp'].find('file:') != -1:
+        with open(config['instr_2_fam_temp'][5:], 'r') as f:
+            instr_2_fam_temp = f.read()
+    else:
+        instr_2_fam_temp = config['instr_2_fam_temp']
+
     # prompt_text = config['instr_1_fam_temp'].format(len(gene_names)) + '\n' + '[CONT]' + '\n'
-    prompt_text = config['instr_1_fam_temp'].format(len(gene_names)) + '\n' + '\n'
+    if get_prompt_layout(config) == 'prefix':
+        # constant instructions before gene summaries, the number of genes is in the variable part
+        prompt_text = config['instr_1_fam_temp'].format(NUM_GENES_PLACEHOLDER) + '\n' + '\n'
+        prompt_text += instr_2_fam_temp + '\n' + '\n'
+        prompt_text += f'Number of genes: {len(gene_names)}\n'
+    else:
+        prompt_text = config['instr_1_fam_temp'].format(len(gene_names)) + '\n' + '\n'
     
     for i in range(len(gene_names)):
         gene_name, gene_response = gene_names[i], gpt4_responses[i]
@@ -126,13 +426,9 @@ def make_family_prompt(gene_names, gpt4_responses, config):
         prompt_text += '\n'
     
     # prompt_text += '[/CONT]\n'
-    prompt_text += '\n'
-    if config['instr_2_fam_temp'].find('file:') != -1:
-        with open(config['instr_2_fam_temp'][5:], 'r') as f:
-            instr_2_fam_temp = f.read()
-    else:
-        instr_2_fam_temp = config['instr_2_fam_temp']
-    prompt_text += instr_2_fam_temp
+    if get_prompt_layout(config) == 'default':
+        prompt_text += '\n'
+        prompt_text += instr_2_fam_temp
     
     return prompt_text
 
@@ -145,22 +441,85 @@ ERROR_STRINGS = ('[' + BAD_SNIPPET_ERROR_STRING + ']',
                  '[' + NCBI_FETCH_ERROR_STRING + ']')
 
 
-def pmcid_to_pmid(pmc_id):
+# number of IDs in one idconv request (the service accepts up to 200)
+IDCONV_BATCH_SIZE = 200
+
+# PMCID -> PMID cache shared by runs and families, see init_pmid_cache
+PMID_CACHE = dict()
+PMID_CACHE_PATH = None
+PMID_CACHE_LOCK = threading.Lock()
+
+
+def init_pmid_cache(path):
+    ''' Loads PMCID -> PMID cache from JSONL file, new conversions are appended to it '''
+    global PMID_CACHE_PATH
+    PMID_CACHE_PATH = path
+    for record in read_jsonl(path):
+        PMID_CACHE[record['pmcid']] = record['pmid']
+    print(f'INFO: {len(PMID_CACHE)} PMCID -> PMID conversions loaded from {path}')
+
+
+def save_pmids_to_cache(pmids):
+    with PMID_CACHE_LOCK:
+        PMID_CACHE.update(pmids)
+        if PMID_CACHE_PATH is None:
+            return
+        with open(PMID_CACHE_PATH, 'a') as f:
+            for pmc_id, pmid in pmids.items():
+                print(json.dumps({'pmcid': pmc_id, 'pmid': pmid}), file=f)
+
+
+def pmcids_to_pmids(pmc_ids, sess=None):
+    ''' Returns dictionary PMCID -> "PMID:..." (or one of the error strings).
+        IDs are taken from the cache or converted with NCBI idconv, IDCONV_BATCH_SIZE IDs per request.
+    '''
     service_root = "https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/"
     email = "iponamareva@ebi.ac.uk"
-    url = service_root + f'?email={email}&ids={pmc_id}'
-    response = requests.get(url)
-    
-    if response.status_code == 200:
+
+    result = dict()
+    to_fetch = []
+    for pmc_id in dict.fromkeys(pmc_ids):
+        if pmc_id in PMID_CACHE:
+            result[pmc_id] = 'PMID:' + PMID_CACHE[pmc_id]
+        else:
+            to_fetch.append(pmc_id)
+
+    if sess is None:
+        sess = requests.Session()
+
+    for i in range(0, len(to_fetch), IDCONV_BATCH_SIZE):
+        batch = to_fetch[i:i + IDCONV_BATCH_SIZE]
+        url = service_root + f'?email={email}&ids={",".join(batch)}'
+        try:
+            response = sess.get(url)
+        except requests.RequestException:
+            response = None
+
+        if response is None or response.status_code != 200:
+            for pmc_id in batch:
+                result[pmc_id] = NCBI_FETCH_ERROR_STRING
+            continue
+
+        found = dict()
         try:
             root = ET.fromstring(response.content)
-            pmid = root.find("record").attrib['pmid']
-            pmid = 'PMID:' + pmid
-        except:
-            pmid = NCBI_PARSE_ERROR_STRING
-    else:
-        pmid = NCBI_FETCH_ERROR_STRING
-    return pmid
+            for record in root.iter('record'):
+                if 'pmid' in record.attrib:
+                    found[record.attrib['requested-id']] = record.attrib['pmid']
+        except ET.ParseError:
+            pass
+        save_pmids_to_cache(found)
+
+        for pmc_id in batch:
+            result[pmc_id] = 'PMID:' + found[pmc_id] if pmc_id in found else NCBI_PARSE_ERROR_STRING
+
+    if len(to_fetch) > 0:
+        print(f'INFO: {len(result) - len(to_fetch)} PMIDs taken from the cache, {len(to_fetch)} converted with NCBI idconv')
+    return result
+
+
+def pmcid_to_pmid(pmc_id):
+    return pmcids_to_pmids([pmc_id])[pmc_id]
 
 
 def normalize_matches(matches, error_strings):
@@ -176,30 +535,44 @@ def normalize_matches(matches, error_strings):
     return d
         
 
-def substitute_pmcid_to_pmid(text, df):
+def substitute_pmcid_to_pmid(text, df, paper_metadata=None):
+    ''' Replaces snippet IDs cited in the text by PMIDs. PMIDs are taken from paper_metadata
+        (saved during snippet search, see utils_snippet_store.py), other papers are converted with pmcids_to_pmids.
+    '''
+    if paper_metadata is None:
+        paper_metadata = dict()
+
     if len(df) == 0:
         print('WARNING: No citations found. This can be an error.')
         return text
         
     citations = set(find_citations(text))
     snippet_error_status =  dict(zip(df['snippet_id'], df['snippet_error']))
-    
+
+    good_citations = [snippet_id for snippet_id in citations if snippet_error_status.get(snippet_id) == False]
+    pmids = dict()
+    for pmc_id in set(snippet_id.split('_')[0] for snippet_id in good_citations):
+        if paper_metadata.get(pmc_id, {}).get('pmid'):
+            pmids[pmc_id] = 'PMID:' + paper_metadata[pmc_id]['pmid']
+    pmids.update(pmcids_to_pmids(sorted(set(snippet_id.split('_')[0] for snippet_id in good_citations) - set(pmids))))
+
+    replacements = dict()
     for snippet_id in citations:
-        idx = text.find(snippet_id)
+        if snippet_id not in snippet_error_status:
+            continue
         if snippet_error_status[snippet_id] == False:
-            pmcid = snippet_id.split('_')[0]
-            # can save them
-            pmid = pmcid_to_pmid(pmcid)
-            text = text.replace(snippet_id, pmid)
+            replacements[snippet_id] = pmids[snippet_id.split('_')[0]]
         else:
-            text = text.replace(snippet_id, BAD_SNIPPET_ERROR_STRING)
+            replacements[snippet_id] = BAD_SNIPPET_ERROR_STRING
+
+    # same pattern as in find_citations; whole IDs are replaced, so PMC1_1 doesn't change PMC1_10
+    text = re.sub(r'\[(\w+_\w+)\]', lambda m: '[' + replacements.get(m.group(1), m.group(1)) + ']', text)
 
     pattern = r"\[PMID:\w+\](?:, \[PMID:\w+\])*"
     matches = re.findall(pattern, text)
 
     d_normed_matches = normalize_matches(matches, error_strings=ERROR_STRINGS)
-    for key in d_normed_matches:
-        text = text.replace(key, d_normed_matches[key])
+    text = re.sub(pattern, lambda m: d_normed_matches[m.group(0)], text)
         
     return text
 
@@ -241,15 +614,18 @@ def get_gpt_family_response(client, query, dir_name, run_name, gene_names, gpt4_
         {"role": "user", "content": prompt_text}
     ]
 
+    start = time.perf_counter()
     response = create_summary(client, messages, model)
-    GPT_USAGE['NUM_CALLS'] += 1
-    GPT_USAGE['NUM_CHARS'] += len(prompt_text)
+    call_usage = get_call_usage(response)
+    add_gpu_usage(GPT_USAGE, call_usage, len(prompt_text))
+    GPT_USAGE['WALL_TIME'] = round(time.perf_counter() - start, 3)
+    print(f'INFO: family summary call: {call_usage["prompt_tokens"]} prompt tokens ({call_usage["cached_tokens"]} cached), {call_usage["completion_tokens"]} completion tokens')
     parsed_response = parse_response(response)
 
     save_response(parsed_response, dir_name, query, run_name, model, N, text_response_dir, type='raw')
 
     df_factcheck = get_family_summary_citations(query, dir_name, parsed_response)
-    pmid_parsed_response = substitute_pmcid_to_pmid(parsed_response, df_factcheck)
+    pmid_parsed_response = substitute_pmcid_to_pmid(parsed_response, df_factcheck, read_paper_metadata(query, dir_name))
     
     save_response(pmid_parsed_response, dir_name, query, run_name, model, N, text_response_dir, type='pmid')
     
@@ -325,8 +701,7 @@ def factcheck_summary(client, query, dir_name, text, config):
         print('Running GPT4 API')
 
         response = create_summary(client, messages, model)
-        GPT_USAGE['NUM_CALLS'] += 1
-        GPT_USAGE['NUM_CHARS'] += len(prompt)
+        add_gpu_usage(GPT_USAGE, get_call_usage(response), len(prompt))
         parsed_response = parse_response(response)
         snippet_ids.append(snippet_id)
         snippet_texts.append(data[snippet_id])
@@ -0,0 +1,18 @@
+''' Reading of the JSONL journals and stores which runs append to. '''
+
+import json
+
+
+def read_jsonl(path):
+    ''' Yields records of a JSONL file (nothing if it doesn't exist).
+        Lines which can't be parsed are skipped: the last line can be cut if a run broke down while writing it.
+    '''
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+    except FileNotFoundError:
+        return
@@ -0,0 +1,52 @@
+''' Ranking of gene snippets by their functional content with BM25.
+
+    Query consists of the gene name and function keywords (config key "rank_keywords" can replace the default ones).
+    Snippets with the highest scores are put into the first gene prompt.
+'''
+
+import numpy as np
+import pandas as pd
+
+
+FUNCTION_KEYWORDS = ['function', 'functions', 'encodes', 'encoded', 'protein', 'enzyme', 'activity', 'catalyzes',
+                     'binds', 'binding', 'domain', 'subunit', 'complex', 'receptor', 'transporter', 'channel',
+                     'regulates', 'regulation', 'pathway', 'signaling', 'involved', 'required', 'role',
+                     'localized', 'localization', 'membrane', 'structure', 'family', 'homolog', 'conserved']
+
+
+def get_rank_query(gene_name, config=None):
+    keywords = FUNCTION_KEYWORDS
+    if config is not None and 'rank_keywords' in config:
+        keywords = config['rank_keywords']
+    gene_terms = pd.Series([gene_name]).str.lower().str.findall(r'\w+')[0]
+    return list(dict.fromkeys(gene_terms + [x.lower() for x in keywords]))
+
+
+def get_bm25_scores(texts, query_terms, k1=1.5, b=0.75):
+    ''' Returns BM25 score of every text for the query terms. '''
+    if len(texts) == 0:
+        return np.zeros(0)
+
+    tokens = pd.Series(list(texts), dtype=str).str.lower().str.findall(r'\w+')
+    doc_len = tokens.str.len().to_numpy(dtype=float)
+    avg_doc_len = max(doc_len.mean(), 1)
+
+    # term frequencies of the query terms only: (number of texts, number of terms)
+    flat = tokens.explode().dropna()
+    flat = flat[flat.isin(query_terms)]
+    tf = pd.crosstab(flat.index, flat).reindex(index=range(len(texts)), columns=query_terms, fill_value=0).to_numpy(dtype=float)
+
+    n_docs = len(texts)
+    doc_freq = (tf > 0).sum(axis=0)
+    idf = np.log((n_docs - doc_freq + 0.5) / (doc_freq + 0.5) + 1)
+
+    norm = k1 * (1 - b + b * doc_len / avg_doc_len)
+    scores = (idf * tf * (k1 + 1) / (tf + norm[:, None])).sum(axis=1)
+    return scores
+
+
+def rank_snippets(df, gene_name, config=None):
+    ''' Returns snippets dataframe sorted by BM25 score (the most relevant first; ties keep the original order) '''
+    scores = get_bm25_scores(df['snippet'], get_rank_query(gene_name, config))
+    order = np.argsort(-scores, kind='stable')
+    return df.iloc[order]
@@ -0,0 +1,225 @@
+''' Access layer for the snippets of the genes of one family.
+
+    Snippets are stored either
+    * in one CSV file per gene: {dir_name}/{query}/snippets_per_gene/{gene_name}.csv (default), or
+    * in one SQLite file per family: {dir_name}/{query}/snippets.sqlite.
+    SQLite store is used for the family if the file exists, see init_sqlite_store.
+    All stages read and write snippets through the functions below.
+
+    Bibliographic metadata of the papers with snippets (PMID, DOI, title, year from EuropePMC search results)
+    is stored next to the snippets: in {dir_name}/{query}/papers.jsonl or in the papers table of the SQLite file.
+'''
+
+import os
+import json
+import sqlite3
+import threading
+import pandas as pd
+
+from utils_io import read_jsonl
+
+
+SNIPPET_COLUMNS = ['paper_id', 'paper_num', 'snippet_num', 'snippet_id', 'snippet']
+PAPER_COLUMNS = ['paper_id', 'pmid', 'doi', 'title', 'year']
+
+# appends to papers.jsonl from parallel gene searches
+papers_lock = threading.Lock()
+
+
+def get_snippets_dir(query, dir_name):
+    return f'{dir_name}/{query}/snippets_per_gene'
+
+
+def get_snippet_db_path(query, dir_name):
+    return f'{dir_name}/{query}/snippets.sqlite'
+
+
+def uses_sqlite_store(query, dir_name):
+    return os.path.exists(get_snippet_db_path(query, dir_name))
+
+
+def connect(query, dir_name):
+    # default rollback journal: WAL doesn't work on networked filesystems
+    conn = sqlite3.connect(get_snippet_db_path(query, dir_name), timeout=600)
+    return conn
+
+
+def init_sqlite_store(query, dir_name):
+    ''' Creates SQLite snippet store for the family. Snippets which are already saved in CSV files are migrated. '''
+    db_exists = uses_sqlite_store(query, dir_name)
+
+    conn = connect(query, dir_name)
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS snippets (
+                            gene_name TEXT NOT NULL,
+                            row_num INTEGER NOT NULL,
+                            paper_id TEXT NOT NULL,
+                            paper_num INTEGER,
+                            snippet_num INTEGER,
+                            snippet_id TEXT,
+                            snippet TEXT,
+                            PRIMARY KEY (gene_name, row_num))''')
+        conn.execute('CREATE INDEX IF NOT EXISTS snippets_paper_id ON snippets (paper_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS snippets_snippet_id ON snippets (snippet_id)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS papers (
+                            paper_id TEXT PRIMARY KEY,
+                            pmid TEXT,
+                            doi TEXT,
+                            title TEXT,
+                            year TEXT)''')
+    conn.close()
+
+    if not db_exists:
+        migrate_csv_to_sqlite(query, dir_name)
+
+
+def migrate_csv_to_sqlite(query, dir_name):
+    ''' One-time migration of snippets_per_gene/*.csv into the SQLite store. CSV files are not removed. '''
+    gene_names = list_csv_genes(query, dir_name)
+    for gene_name in gene_names:
+        df = pd.read_csv(f'{get_snippets_dir(query, dir_name)}/{gene_name}.csv')
+        write_gene_snippets(query, dir_name, gene_name, df)
+    if os.path.exists(get_papers_path(query, dir_name)):
+        write_paper_metadata(query, dir_name, read_csv_paper_metadata(query, dir_name))
+    print(f'INFO: Migrated snippets of {len(gene_names)} genes from CSV files to', get_snippet_db_path(query, dir_name))
+
+
+def list_csv_genes(query, dir_name):
+    snippets_path = get_snippets_dir(query, dir_name)
+    if not os.path.exists(snippets_path):
+        return []
+    # hidden files are temporary files of unfinished writes
+    return sorted([x[:-4] for x in os.listdir(snippets_path) if x[0] != '.' and x.endswith('.csv')])
+
+
+def list_snippet_genes(query, dir_name):
+    ''' Returns names of the genes which have snippets, sorted '''
+    if not uses_sqlite_store(query, dir_name):
+        return list_csv_genes(query, dir_name)
+
+    conn = connect(query, dir_name)
+    gene_names = [row[0] for row in conn.execute('SELECT DISTINCT gene_name FROM snippets ORDER BY gene_name')]
+    conn.close()
+    return gene_names
+
+
+def read_gene_snippets(query, dir_name, gene_name):
+    ''' Returns dataframe with snippets of the gene. Raises FileNotFoundError if there are no snippets. '''
+    if not uses_sqlite_store(query, dir_name):
+        return pd.read_csv(f'{get_snippets_dir(query, dir_name)}/{gene_name}.csv')
+
+    conn = connect(query, dir_name)
+    df = pd.read_sql_query(f'SELECT {", ".join(SNIPPET_COLUMNS)} FROM snippets WHERE gene_name = ? ORDER BY row_num',
+                           conn, params=(gene_name,))
+    conn.close()
+    if len(df) == 0:
+        raise FileNotFoundError(f'No snippets for gene {gene_name} in {get_snippet_db_path(query, dir_name)}')
+    # same as in CSV files: snippet IDs appear after enumerate_snippets
+    if df['snippet_id'].isna().all():
+        df = df.drop(columns=['snippet_id'])
+    return df
+
+
+def write_gene_snippets(query, dir_name, gene_name, df):
+    ''' Saves (or replaces) snippets of the gene. Readers never see partially written snippets. '''
+    if not uses_sqlite_store(query, dir_name):
+        snippets_path = get_snippets_dir(query, dir_name)
+        tmp_path = f'{snippets_path}/.{gene_name}.csv.{os.getpid()}.{threading.get_ident()}.tmp'
+        df.to_csv(tmp_path)
+        os.replace(tmp_path, f'{snippets_path}/{gene_name}.csv')
+        return
+
+    df = df.reset_index(drop=True)
+    rows = []
+    for i, row in enumerate(df.to_dict('records')):
+        rows.append((gene_name, i) + tuple(row.get(column) for column in SNIPPET_COLUMNS))
+
+    conn = connect(query, dir_name)
+    with conn:
+        conn.execute('DELETE FROM snippets WHERE gene_name = ?', (gene_name,))
+        conn.executemany(f'INSERT INTO snippets (gene_name, row_num, {", ".join(SNIPPET_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.close()
+
+
+def list_genes_without_snippet_ids(query, dir_name):
+    ''' Returns names of the genes whose snippets have no snippet IDs (not enumerated or rewritten after enumeration), sorted '''
+    if not uses_sqlite_store(query, dir_name):
+        snippets_path = get_snippets_dir(query, dir_name)
+        # header only
+        return [gene_name for gene_name in list_csv_genes(query, dir_name)
+                if 'snippet_id' not in pd.read_csv(f'{snippets_path}/{gene_name}.csv', nrows=0).columns]
+
+    conn = connect(query, dir_name)
+    gene_names = [row[0] for row in conn.execute('SELECT DISTINCT gene_name FROM snippets WHERE snippet_id IS NULL ORDER BY gene_name')]
+    conn.close()
+    return gene_names
+
+
+def get_gene_snippet_counts(query, dir_name, gene_name):
+    ''' Returns number of papers and number of snippets for the gene '''
+    if not uses_sqlite_store(query, dir_name):
+        df_path = f'{get_snippets_dir(query, dir_name)}/{gene_name}.csv'
+        if not os.path.exists(df_path):
+            return 0, 0
+        df = pd.read_csv(df_path)
+        return len(set(df['paper_id'])), len(df)
+
+    conn = connect(query, dir_name)
+    num_papers, num_snippets = conn.execute('SELECT COUNT(DISTINCT paper_id), COUNT(*) FROM snippets WHERE gene_name = ?', (gene_name,)).fetchone()
+    conn.close()
+    return num_papers, num_snippets
+
+
+def get_all_gene_snippet_counts(query, dir_name):
+    ''' Returns dictionary gene_name -> (number of papers, number of snippets) for all genes with snippets.
+        SQLite store answers with one query instead of one connection per gene.
+    '''
+    if not uses_sqlite_store(query, dir_name):
+        return {gene_name: get_gene_snippet_counts(query, dir_name, gene_name) for gene_name in list_csv_genes(query, dir_name)}
+
+    conn = connect(query, dir_name)
+    rows = conn.execute('SELECT gene_name, COUNT(DISTINCT paper_id), COUNT(*) FROM snippets GROUP BY gene_name ORDER BY gene_name').fetchall()
+    conn.close()
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+
+def get_papers_path(query, dir_name):
+    return f'{dir_name}/{query}/papers.jsonl'
+
+
+def write_paper_metadata(query, dir_name, paper_metadata):
+    ''' Saves metadata of the papers: dictionary paper_id -> {"pmid", "doi", "title", "year"} '''
+    if len(paper_metadata) == 0:
+        return
+
+    if not uses_sqlite_store(query, dir_name):
+        with papers_lock:
+            with open(get_papers_path(query, dir_name), 'a') as f:
+                for paper_id, metadata in paper_metadata.items():
+                    print(json.dumps(dict(paper_id=paper_id, **metadata)), file=f)
+        return
+
+    rows = [tuple([paper_id] + [metadata.get(column) for column in PAPER_COLUMNS[1:]]) for paper_id, metadata in paper_metadata.items()]
+    conn = connect(query, dir_name)
+    with conn:
+        conn.executemany(f'INSERT OR REPLACE INTO papers ({", ".join(PAPER_COLUMNS)}) VALUES (?, ?, ?, ?, ?)', rows)
+    conn.close()
+
+
+def read_csv_paper_metadata(query, dir_name):
+    paper_metadata = dict()
+    for record in read_jsonl(get_papers_path(query, dir_name)):
+        # papers found again later replace the earlier records
+        paper_metadata[record.pop('paper_id')] = record
+    return paper_metadata
+
+
+def read_paper_metadata(query, dir_name):
+    ''' Returns dictionary paper_id -> {"pmid", "doi", "title", "year"} (empty if metadata wasn't saved) '''
+    if not uses_sqlite_store(query, dir_name):
+        return read_csv_paper_metadata(query, dir_name)
+
+    conn = connect(query, dir_name)
+    rows = conn.execute(f'SELECT {", ".join(PAPER_COLUMNS)} FROM papers').fetchall()
+    conn.close()
+    return {row[0]: dict(zip(PAPER_COLUMNS[1:], row[1:])) for row in rows}
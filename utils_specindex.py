@@ -0,0 +1,225 @@
+''' Offline gene specificity index, used by utils_famfilter instead of UniProt queries.
+
+    The index is built in one streaming pass over a UniProt TSV dump with "Gene Names" and "PANTHER" columns
+    (e.g. https://rest.uniprot.org/uniprotkb/stream?query=*&fields=accession,gene_names,xref_panther&format=tsv&compressed=true);
+    counts of each chunk are spilled to disk and merged, so memory doesn't grow with the size of the dump:
+        python utils_specindex.py -dump uniprot_panther.tsv.gz -index DIR
+    Gene names are lowercased and every entry counts for each of its gene names, PANTHER subfamilies are not counted
+    (same as get_cross_reference_counts). The index directory has numpy arrays which are memory-mapped when the index is used:
+    * gene_names.npy: sorted gene names (UTF-8 bytes)
+    * gene_stats.npy: number of entries and number of entries with PANTHER families of each gene
+    * gene_offsets.npy: range of each gene in the pair arrays
+    * pair_families.npy, pair_counts.npy: PANTHER family (index in families.npy) and number of entries, sorted by family within a gene
+    * families.npy: sorted PANTHER family IDs
+    Unlike UniProt queries, all entries of a gene are counted (not only the first 2000).
+'''
+
+import os
+import json
+import heapq
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+from itertools import groupby
+from numpy.lib.format import open_memmap
+from datetime import datetime
+
+
+INDEX_ARRAYS = ['gene_names', 'gene_stats', 'gene_offsets', 'pair_families', 'pair_counts', 'families']
+# spilled runs are merged into one when there are more of them, so merging doesn't open too many files
+MAX_RUNS = 128
+
+
+def get_chunk_counts(df):
+    ''' Returns counts of one chunk of the dump, sorted by gene name:
+        dataframe gene_name, entries, panther_entries (entries with PANTHER families) and
+        dataframe gene_name, family, entries
+    '''
+    gene_names = df['Gene Names'].fillna('').str.lower().str.split().map(lambda x: list(dict.fromkeys(x)))
+    gene_names = gene_names.explode().dropna().rename('gene_name')
+
+    families = df['PANTHER'].fillna('').astype(str).str.split(';').explode().str.strip().rename('family')
+    families = families[(families != '') & (~families.str.contains(':', regex=False))]
+    families = families.reset_index().drop_duplicates().set_index('index')['family']
+
+    gene_counts = pd.DataFrame({'entries': gene_names.value_counts(),
+                                'panther_entries': gene_names[gene_names.index.isin(families.index)].value_counts()})
+    gene_counts = gene_counts.fillna(0).astype(np.int64).rename_axis('gene_name').reset_index().sort_values('gene_name')
+    pair_counts = gene_names.to_frame().join(families, how='inner').groupby(['gene_name', 'family']).size().rename('entries').reset_index()
+    return gene_counts, pair_counts.sort_values(['gene_name', 'family'])
+
+
+def iter_run_file(path):
+    ''' Yields rows of a spilled run: tuples of strings, counts are the last fields '''
+    with open(path, 'r') as f:
+        for line in f:
+            yield tuple(line.rstrip('\n').split('\t'))
+
+
+def merge_runs(paths, num_keys):
+    ''' Merges sorted runs, rows with the same first num_keys fields are summed. Yields (keys, counts). '''
+    rows = heapq.merge(*[iter_run_file(path) for path in paths], key=lambda row: row[:num_keys])
+    for keys, group in groupby(rows, key=lambda row: row[:num_keys]):
+        counts = None
+        for row in group:
+            row_counts = [int(x) for x in row[num_keys:]]
+            counts = row_counts if counts is None else [x + y for x, y in zip(counts, row_counts)]
+        yield keys, counts
+
+
+def write_merged_run(paths, num_keys, out_path):
+    with open(out_path, 'w') as f:
+        for keys, counts in merge_runs(paths, num_keys):
+            f.write('\t'.join(list(keys) + [str(x) for x in counts]) + '\n')
+    for path in paths:
+        os.remove(path)
+
+
+class ArrayWriter:
+    ''' Appends values to a raw file in blocks, so arrays of any size are written with bounded memory '''
+    def __init__(self, path, dtype, row_shape=(), block_size=1000000):
+        self.path, self.dtype, self.row_shape, self.block_size = path, np.dtype(dtype), row_shape, block_size
+        self.num_rows = 0
+        self._block = []
+        self._f = open(path + '.raw', 'wb')
+
+    def append(self, value):
+        self._block.append(value)
+        if len(self._block) >= self.block_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self._block) > 0:
+            self._f.write(np.array(self._block, dtype=self.dtype).reshape((-1,) + self.row_shape).tobytes())
+            self.num_rows += len(self._block)
+            self._block = []
+
+    def save(self):
+        ''' Converts the raw file into .npy '''
+        self._flush()
+        self._f.close()
+        shape = (self.num_rows,) + self.row_shape
+        if self.num_rows == 0:
+            np.save(self.path, np.zeros(shape, dtype=self.dtype))
+        else:
+            src = np.memmap(self.path + '.raw', dtype=self.dtype, mode='r', shape=shape)
+            dst = open_memmap(self.path, mode='w+', dtype=self.dtype, shape=shape)
+            for start in range(0, self.num_rows, self.block_size):
+                dst[start:start + self.block_size] = src[start:start + self.block_size]
+            dst.flush()
+            del src, dst
+        os.remove(self.path + '.raw')
+
+
+def build_spec_index(dump_path, index_dir, chunksize=200000):
+    ''' Counts of each chunk are spilled to sorted run files in index_dir, then the runs are merged into the arrays,
+        so memory doesn't grow with the size of the dump (only the set of PANTHER families is kept in memory).
+    '''
+    os.makedirs(index_dir, exist_ok=True)
+    runs_dir = os.path.join(index_dir, 'runs')
+    os.makedirs(runs_dir, exist_ok=True)
+    gene_runs, pair_runs = [], []
+    families = set()
+    max_name_len, num_entries = 1, 0
+
+    chunks = pd.read_csv(dump_path, sep='\t', dtype=str, usecols=['Gene Names', 'PANTHER'], chunksize=chunksize)
+    for i, df in enumerate(chunks):
+        num_entries += len(df)
+        gene_counts, pair_counts = get_chunk_counts(df)
+        families.update(pair_counts['family'])
+        if len(gene_counts) > 0:
+            max_name_len = max(max_name_len, int(gene_counts['gene_name'].str.encode('utf-8').str.len().max()))
+
+        gene_runs.append(os.path.join(runs_dir, f'genes_{i}.tsv'))
+        pair_runs.append(os.path.join(runs_dir, f'pairs_{i}.tsv'))
+        gene_counts.to_csv(gene_runs[-1], sep='\t', header=False, index=False)
+        pair_counts.to_csv(pair_runs[-1], sep='\t', header=False, index=False)
+        if len(gene_runs) >= MAX_RUNS:
+            write_merged_run(gene_runs, 1, os.path.join(runs_dir, f'genes_{i}_merged.tsv'))
+            write_merged_run(pair_runs, 2, os.path.join(runs_dir, f'pairs_{i}_merged.tsv'))
+            gene_runs, pair_runs = [os.path.join(runs_dir, f'genes_{i}_merged.tsv')], [os.path.join(runs_dir, f'pairs_{i}_merged.tsv')]
+        print(f'INFO: Read {num_entries} entries')
+
+    # names are sorted as bytes, the same order as searchsorted uses (UTF-8 keeps the order of code points)
+    families = sorted(families)
+    family_ids = {x: i for i, x in enumerate(families)}
+
+    path = lambda name: os.path.join(index_dir, name + '.npy')
+    gene_names = ArrayWriter(path('gene_names'), f'S{max_name_len}')
+    gene_stats = ArrayWriter(path('gene_stats'), np.int64, row_shape=(2,))
+    gene_offsets = ArrayWriter(path('gene_offsets'), np.int64)
+    pair_families = ArrayWriter(path('pair_families'), np.int32)
+    pair_counts = ArrayWriter(path('pair_counts'), np.int64)
+
+    # pairs are sorted by gene like the genes, and every gene of a pair has entries
+    pairs = merge_runs(pair_runs, 2)
+    pair = next(pairs, None)
+    num_pairs = 0
+    gene_offsets.append(0)
+    for (gene_name,), (entries, panther_entries) in merge_runs(gene_runs, 1):
+        gene_names.append(gene_name.encode())
+        gene_stats.append((entries, panther_entries))
+        while pair is not None and pair[0][0] == gene_name:
+            pair_families.append(family_ids[pair[0][1]])
+            pair_counts.append(pair[1][0])
+            num_pairs += 1
+            pair = next(pairs, None)
+        gene_offsets.append(num_pairs)
+
+    for writer in (gene_names, gene_stats, gene_offsets, pair_families, pair_counts):
+        writer.save()
+    np.save(path('families'), np.array([x.encode() for x in families], dtype=bytes))
+    shutil.rmtree(runs_dir)
+
+    # written last: the index is complete only if meta.json exists
+    meta = {'dump': os.path.abspath(dump_path), 'num_entries': num_entries, 'num_gene_names': gene_names.num_rows,
+            'num_families': len(families), 'built_at': datetime.now().isoformat(timespec='seconds')}
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    print(f'INFO: Built specificity index in {index_dir}: {num_entries} entries, {gene_names.num_rows} gene names, {len(families)} PANTHER families')
+
+
+class SpecIndex:
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        for name in INDEX_ARRAYS:
+            setattr(self, name, np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r'))
+
+    def _find(self, names, name):
+        key = name.encode()
+        i = int(np.searchsorted(names, key))
+        if i < len(names) and names[i] == key:
+            return i
+        return None
+
+    def get_hits(self, family, gene_name):
+        ''' Returns (all, pos, false) entry counts, same as get_hits_for_gene_name; zeros if the gene is not in the index '''
+        i = self._find(self.gene_names, gene_name.lower())
+        if i is None:
+            return 0, 0, 0
+        all_hits, panther_hits = (int(x) for x in self.gene_stats[i])
+
+        pos_hits = 0
+        j = self._find(self.families, family)
+        if j is not None:
+            start, end = int(self.gene_offsets[i]), int(self.gene_offsets[i + 1])
+            k = start + int(np.searchsorted(self.pair_families[start:end], j))
+            if k < end and self.pair_families[k] == j:
+                pos_hits = int(self.pair_counts[k])
+        return all_hits, pos_hits, panther_hits - pos_hits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-dump', '--dump', type=str, required=True, help='UniProt TSV file (can be compressed) with "Gene Names" and "PANTHER" columns')
+    parser.add_argument('-index', '--index-dir', type=str, required=True, help='directory for the index')
+    parser.add_argument('-chunksize', '--chunksize', type=int, default=200000, help='number of entries read at once, default=200000')
+    args = parser.parse_args()
+
+    build_spec_index(args.dump, args.index_dir, chunksize=args.chunksize)
+
+
+if __name__ == "__main__":
+    main()